@@ -0,0 +1,42 @@
+"""
+Async Server
+
+Serves the same app as server.py with gevent. Each request runs in a greenlet
+instead of holding a thread, and monkey-patching makes the sockets used by
+pymysql cooperative, so a request waiting on MySQL lets the others run. One
+process can then keep thousands of requests in flight, with the same routes
+and the same deserialize/serialize validation.
+
+The service runs on Python 2.7 (see runtime.txt), where ASGI servers and the
+asyncio MySQL drivers are not available; gevent gives the same non-blocking
+model to the existing WSGI app and its pure-Python driver. For local runs,
+point DATABASE_URI at SQLite (sqlite:////tmp/payments.db); its calls block
+the process, so it is not a way to measure concurrency.
+
+Connections are still capped by the pool (DB_POOL_SIZE + DB_MAX_OVERFLOW),
+so requests beyond that wait up to DB_POOL_TIMEOUT for one.
+
+Usage: python async_server.py (after python migrations.py has created the tables)
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import logging
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from server import app, PORT
+
+# Most requests handled at once by one process
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', '10000'))
+
+
+def make_server(host='0.0.0.0', port=int(PORT)):
+    """ Returns a gevent WSGI server for the app, limited to MAX_CONCURRENCY greenlets """
+    return WSGIServer((host, port), app, spawn=Pool(MAX_CONCURRENCY), log=None)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.info("Serving on port %s with up to %d concurrent requests", PORT, MAX_CONCURRENCY)
+    make_server().serve_forever()
@@ -0,0 +1,8 @@
+"""
+Benchmarks for the Payments service. Run each module from the repository root
+with python -m, e.g. python -m benchmarks.serializers
+
+    benchmarks.micro        model serialize/deserialize and query methods
+    benchmarks.scenarios    API throughput and latency over HTTP, in-process
+    benchmarks.compare      flags regressions between two --output JSON files
+"""
@@ -0,0 +1,54 @@
+"""
+Benchmark Comparison
+
+Compares a run against a baseline, both written with --output by
+benchmarks.micro or benchmarks.scenarios. A benchmark regresses when its
+throughput drops, or its p95 latency grows, by more than --threshold. The
+exit status is 1 when anything regressed, so the check can gate a build.
+
+Usage: python -m benchmarks.compare BASELINE CURRENT [--threshold 0.10]
+"""
+import sys
+import argparse
+from benchmarks import report
+
+
+def compare(baseline, current, threshold=0.10):
+    """ Returns (name, metric, baseline value, current value, change, regressed) for each shared benchmark """
+    rows = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        before = baseline['results'][name]
+        after = current['results'][name]
+        for metric, higher_is_better in (('ops_per_sec', True), ('p95_ms', False)):
+            if metric not in before or metric not in after or not before[metric]:
+                continue
+            change = (after[metric] - before[metric]) / float(before[metric])
+            regressed = -change > threshold if higher_is_better else change > threshold
+            rows.append((name, metric, before[metric], after[metric], change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark runs')
+    parser.add_argument('baseline', help='JSON results of the reference run')
+    parser.add_argument('current', help='JSON results of the run to check')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='largest change tolerated, as a fraction (default 0.10)')
+    args = parser.parse_args()
+    baseline = report.load(args.baseline)
+    current = report.load(args.current)
+    if baseline['suite'] != current['suite'] or baseline['database'] != current['database']:
+        print 'Warning: comparing %s on %s against %s on %s' % (
+            current['suite'], current['database'], baseline['suite'], baseline['database'])
+
+    rows = compare(baseline, current, args.threshold)
+    for name, metric, before, after, change, regressed in rows:
+        print '  %-32s %-12s %12.3f -> %12.3f  %+7.1f%%%s' % (
+            name, metric, before, after, change * 100, '  REGRESSION' if regressed else '')
+    regressions = [row for row in rows if row[-1]]
+    print '%d of %d measurements regressed by more than %.0f%%' % (len(regressions), len(rows), args.threshold * 100)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
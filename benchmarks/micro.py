@@ -0,0 +1,80 @@
+"""
+Model Micro-benchmarks
+
+Times the model layer on its own: Payment.serialize/deserialize and the query
+methods the routes are built on, against a table of --rows payments.
+
+Usage: python -m benchmarks.micro [--rows N] [--number N] [--output FILE]
+Runs against DATABASE_URI, which defaults to a SQLite file in /tmp.
+"""
+import os
+import argparse
+
+os.environ.setdefault('DATABASE_URI', 'sqlite:////tmp/payments_benchmark.db')
+
+from server import app, db, Payment, PaymentMethod, PaymentMethodType, PaymentStatus
+from benchmarks import report
+
+# Distinct users and orders in the generated table, so filters match rows/USERS payments
+USERS = 1000
+METHODS = 10
+
+
+def load(rows):
+    """ Recreates the tables with rows payments spread over USERS users and METHODS methods """
+    db.drop_all()
+    db.create_all()
+    for n in range(METHODS):
+        PaymentMethod(method_type=PaymentMethodType.CREDIT, is_default=False).save()
+    statuses = list(PaymentStatus)
+    Payment.bulk_insert([Payment(user_id=n % USERS, order_id=n, status=statuses[n % len(statuses)],
+                                 method_id=n % METHODS + 1)
+                         for n in range(rows)])
+
+
+def run(rows, number):
+    """ Returns the results of each micro-benchmark """
+    payment = Payment.find(rows // 2)
+    method = PaymentMethod.find(1)
+    data = payment.serialize()
+    # A different key on every call, so find() does not answer from the session's identity map
+    ids = iter(xrange(1, 10 ** 9))
+    benchmarks = {
+        'payment.serialize': (lambda: payment.serialize(), number * 10),
+        'payment.deserialize': (lambda: Payment().deserialize(data), number * 10),
+        'payment_method.serialize': (lambda: method.serialize(), number * 10),
+        'payment.find': (lambda: Payment.find(next(ids) % rows + 1), number),
+        'payment.find_serialized_cached': (lambda: Payment.find_serialized(rows // 3), number),
+        'payment.find_by_user': (lambda: Payment.find_by_user(next(ids) % USERS).all(), number // 10),
+        'payment.find_by_order': (lambda: Payment.find_by_order(next(ids) % rows).all(), number),
+        'payment.find_by_filters': (lambda: Payment.find_by_filters(
+            user_id=next(ids) % USERS, status=PaymentStatus.PAID).all(), number // 10),
+        'payment.rows_page': (lambda: list(Payment.rows(Payment.keyset(Payment.query).limit(100))), number // 10),
+        'payment_method.find_default': (lambda: PaymentMethod.find_default(), number),
+    }
+    results = {}
+    for name, (function, count) in sorted(benchmarks.items()):
+        results[name] = report.measure(function, max(count, 1))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model micro-benchmarks')
+    parser.add_argument('--rows', type=int, default=10000, help='payments in the table')
+    parser.add_argument('--number', type=int, default=1000, help='calls per timed run')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+    with app.app_context():
+        load(args.rows)
+        results = run(args.rows, args.number)
+        database = db.engine.dialect.name
+        db.session.remove()
+        db.drop_all()
+    print 'Model micro-benchmarks, %d payments on %s (best of 3)' % (args.rows, database)
+    report.print_results(results)
+    if args.output:
+        report.save(args.output, 'micro', database, vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
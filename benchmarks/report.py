@@ -0,0 +1,72 @@
+"""
+Benchmark Reports
+
+Timing helpers shared by the benchmarks, and the JSON file each run writes so
+that runs can be compared with python -m benchmarks.compare.
+"""
+import json
+import platform
+import time
+from datetime import datetime
+
+
+def measure(function, number, repeat=3):
+    """ Returns the rate and cost of function, from the fastest of repeat runs of number calls """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    best = max(best, 1e-9)
+    return {'ops_per_sec': round(number / best, 1), 'us_per_op': round(best / number * 1e6, 2)}
+
+def percentile(ordered, fraction):
+    """ Returns the value below which fraction of the sorted values fall """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def summarize(latencies, elapsed, errors=0):
+    """ Returns the throughput and latency percentiles of a load run, in milliseconds """
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'ops_per_sec': round(len(ordered) / max(elapsed, 1e-9), 1),
+        'mean_ms': round(sum(ordered) / max(len(ordered), 1) * 1000, 3),
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+        'max_ms': round((ordered[-1] if ordered else 0.0) * 1000, 3),
+    }
+
+def save(path, suite, database, settings, results):
+    """ Writes the results of a run, with what is needed to tell runs apart, as JSON """
+    report = {
+        'suite': suite,
+        'created_at': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': database,
+        'settings': settings,
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def print_results(results):
+    for name in sorted(results):
+        result = results[name]
+        line = '  %-32s %12.1f ops/s' % (name, result['ops_per_sec'])
+        if 'p95_ms' in result:
+            line += '  p50 %8.3fms  p95 %8.3fms  p99 %8.3fms' % (result['p50_ms'], result['p95_ms'], result['p99_ms'])
+        elif 'us_per_op' in result:
+            line += '  %10.2fus/op' % result['us_per_op']
+        print line
@@ -0,0 +1,55 @@
+"""
+Serializer Benchmark
+
+Compares two ways of building the body of a large GET /payments: loading a
+Payment per row and calling serialize(), as list_payments used to, against
+building the dicts straight from the row tuples with Payment.rows().
+
+Usage: python -m benchmarks.serializers [rows]
+Runs against DATABASE_URI, which defaults to a SQLite file in /tmp.
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault('DATABASE_URI', 'sqlite:////tmp/payments_benchmark.db')
+
+from server import app, db, json, encode_json, fast_json, Payment, PaymentMethod, PaymentMethodType, PaymentStatus
+
+
+def best_of(function, repeat=3):
+    """ Returns the fastest of several timed runs of function, in seconds """
+    times = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(rows=100000):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        method = PaymentMethod(method_type=PaymentMethodType.CREDIT, is_default=False)
+        method.save()
+        Payment.bulk_insert([Payment(user_id=n % 1000, order_id=n, status=PaymentStatus.PAID, method_id=method.id)
+                             for n in range(rows)])
+        query = Payment.keyset(Payment.query)
+
+        orm = best_of(lambda: json.dumps([payment.serialize() for payment in query.all()]))
+        columns = best_of(lambda: json.dumps(list(Payment.rows(query))))
+        encoded = best_of(lambda: encode_json(list(Payment.rows(query))))
+
+        encoder = 'ujson' if fast_json else 'json'
+        print 'Serializing %d payments (best of 3)' % rows
+        print '  %-30s %.3fs' % ('ORM objects + serialize()', orm)
+        print '  %-30s %.3fs  %.1fx' % ('Payment.rows()', columns, orm / columns)
+        print '  %-30s %.3fs  %.1fx' % ('Payment.rows() + ' + encoder, encoded, orm / encoded)
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,179 @@
+"""
+Cache
+
+Read-through cache of serialized Payments and Payment Methods. The models
+invalidate the entries they write, so reads after our own writes are fresh.
+
+The backend is picked from the environment:
+    CACHE_URL   a redis:// URL of any Redis-protocol server. Without it each
+                process keeps its own LRU, which only sees that process's writes,
+                so gunicorn_config.py turns caching off for several workers
+                unless CACHE_URL is set.
+    CACHE_TTL   seconds an entry lives (default 30), 0 turns the cache off
+    CACHE_SIZE  entries kept by the in-process LRU (default 10000)
+
+method_ids holds the ids of existing Payment Methods, which validating a
+Payment's method_id checks first. METHOD_IDS_TTL sets how many seconds it is
+trusted (default 60).
+"""
+import os
+import json
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Every key is namespaced, so a shared Redis can hold other data too
+KEY_PREFIX = 'payments:'
+
+
+class NullCache(object):
+    """ A cache that never holds anything """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def delete_prefix(self, prefix):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(object):
+    """ An in-process cache that drops the least recently used entry when full """
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache(object):
+    """ A cache shared by every worker, kept in a Redis-protocol server """
+
+    def __init__(self, client, ttl=30):
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(KEY_PREFIX + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.setex(KEY_PREFIX + key, self.ttl, json.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[KEY_PREFIX + key for key in keys])
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=KEY_PREFIX + prefix + '*', count=1000))
+        for start in range(0, len(keys), 1000):
+            self.client.delete(*keys[start:start + 1000])
+
+    def clear(self):
+        self.delete_prefix('')
+
+
+class IdSet(object):
+    """
+    Ids known to exist, e.g. of Payment Methods, so checking one seldom needs a
+    query. Writes in this process keep it exact; the whole set is forgotten
+    every ttl seconds, which bounds how long a delete made by another worker
+    goes unnoticed. A ttl of 0 keeps nothing.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._ids = set()
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        if now >= self._expires:
+            self._ids.clear()
+            self._expires = now + self.ttl
+
+    def missing(self, ids):
+        """ Returns the ids that are not known to exist """
+        with self._lock:
+            self._expire()
+            return set(ids) - self._ids
+
+    def add(self, *ids):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._expire()
+            self._ids.update(ids)
+
+    def discard(self, *ids):
+        with self._lock:
+            self._ids.difference_update(ids)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+def make_cache():
+    """ Returns the cache backend configured by the environment """
+    ttl = int(os.getenv('CACHE_TTL', '30'))
+    if ttl <= 0:
+        return NullCache()
+    url = os.getenv('CACHE_URL')
+    if url:
+        if redis is None:
+            raise RuntimeError('CACHE_URL is set but the redis package is not installed')
+        return RedisCache(redis.StrictRedis.from_url(url), ttl)
+    return LRUCache(int(os.getenv('CACHE_SIZE', '10000')), ttl)
+
+cache = make_cache()
+method_ids = IdSet(int(os.getenv('METHOD_IDS_TTL', '60')))
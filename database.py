@@ -0,0 +1,76 @@
+"""
+Database
+
+The SQLAlchemy extension used by the service. For MySQL it sizes the
+connection pool from the environment (see vcap_services.get_pool_options)
+and records how long each checkout waits for a connection, so workers can be
+sized against the database connection limit.
+
+db is bound to an app by server.create_app(), so importing it (and the
+models) does not connect to anything.
+"""
+import time
+from flask import has_app_context
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+from vcap_services import get_pool_options
+import metrics
+
+POOL_CHECKOUT_SECONDS = metrics.Histogram(
+    'db_pool_checkout_seconds', 'Time spent waiting for a connection from the pool')
+POOL_CHECKOUT_TIMEOUTS = metrics.Counter(
+    'db_pool_checkout_timeouts_total', 'Checkouts that gave up after the pool timeout')
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that records how long each checkout waits for a connection """
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except TimeoutError:
+            POOL_CHECKOUT_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(time.time() - start)
+
+
+class PaymentsSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy extension that configures the MySQL connection pool """
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('mysql'):
+            options.update(get_pool_options())
+            options['poolclass'] = TimedQueuePool
+        super(PaymentsSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+
+def register_pool_metrics(db):
+    """ Adds gauges for the size and saturation of the connection pool of db """
+    def queue_pool():
+        if not has_app_context():
+            return None
+        pool = db.engine.pool
+        return pool if isinstance(pool, QueuePool) else None
+
+    def checked_out():
+        pool = queue_pool()
+        return pool.checkedout() if pool else None
+
+    def saturation():
+        pool = queue_pool()
+        max_overflow = get_pool_options()['max_overflow']
+        if not pool or max_overflow < 0:
+            return None
+        return float(pool.checkedout()) / (pool.size() + max_overflow)
+
+    metrics.Gauge('db_pool_size', 'Connections the pool keeps open',
+                  lambda: queue_pool() and queue_pool().size())
+    metrics.Gauge('db_pool_checked_out', 'Connections currently checked out of the pool', checked_out)
+    metrics.Gauge('db_pool_saturation', 'Checked out connections as a fraction of the most the pool allows', saturation)
+
+
+db = PaymentsSQLAlchemy()
+register_pool_metrics(db)
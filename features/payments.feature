@@ -4,7 +4,12 @@ Feature: The pet store service back-end
     So that I can keep track of all my payments
 
 Background:
-    Given the following payments:
+    Given the following payment methods:
+      | id | method_type |
+      |  1 |      1      |
+      |  2 |      2      |
+      |  3 |      3      |
+    And the following payments:
       | id | user_id | order_id | status    | method_id |
       |  0 |    4    |   7      | 1         |   1       |
       |  1 |    5    |   8      | 3         |   3       |
@@ -18,6 +18,22 @@ import time
 WAIT_SECONDS = 30
 BASE_URL = getenv('BASE_URL', 'http://localhost:5000')
 
+@given(u'the following payment methods')
+def step_impl(context):
+    """ Create the Payment Methods the payments refer to, unless they exist """
+    headers = {'Content-Type': 'application/json'}
+    for row in context.table:
+        method_url = BASE_URL + '/payments/methods/' + row['id']
+        context.resp = requests.get(method_url)
+        if context.resp.status_code == 200:
+            continue
+        data = {
+            "id": int(row['id']),
+            "method_type": int(row['method_type'])
+            }
+        context.resp = requests.post(BASE_URL + '/payments/methods', data=json.dumps(data), headers=headers)
+        expect(context.resp.status_code).to_equal(201)
+
 @given(u'the following payments')
 def step_impl(context):
     """ Delete all Payments and load new ones """
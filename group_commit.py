@@ -0,0 +1,99 @@
+"""
+Group Commit
+
+Lets concurrent POST /payments requests share one transaction. The first
+request to arrive opens a batch and waits up to GROUP_COMMIT_WINDOW_MS for
+others to join it, or until GROUP_COMMIT_MAX_ROWS have joined, then inserts
+the whole batch with one multi-row INSERT and one commit. Every request in
+the batch is answered only after that commit, so an acknowledged payment is
+as durable as one saved on its own, while the fsync of each commit is shared.
+
+A failed batch is retried one payment at a time, so a bad row only fails
+its own request. Requests with an Idempotency-Key are not grouped, since
+their key is committed together with the payment.
+
+It pays off with gevent or threaded workers, where requests overlap in one
+process. A sync worker serves one request at a time, so each batch would
+hold one payment and only add the window to its latency.
+
+Settings come from the environment:
+    GROUP_COMMIT             True to turn group commit on (default False)
+    GROUP_COMMIT_WINDOW_MS   longest the first request of a batch waits (default 5)
+    GROUP_COMMIT_MAX_ROWS    a batch is written as soon as it has this many (default 100)
+"""
+import os
+import threading
+import metrics
+from models import Payment
+
+BATCH_ROWS = metrics.Histogram(
+    'group_commit_rows', 'Payments written by one group commit', buckets=(1, 2, 5, 10, 20, 50, 100, 250, 1000))
+
+
+def enabled():
+    """ Returns True when GROUP_COMMIT turns group commit on """
+    return os.getenv('GROUP_COMMIT', 'False') == 'True'
+
+
+class Batch(object):
+    """ The payments waiting for one commit """
+
+    def __init__(self):
+        self.payments = []
+        self.errors = {}
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """ Gathers the payments inserted by concurrent requests into shared commits """
+
+    def __init__(self, window=0.005, max_rows=100):
+        self.window = window
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def insert(self, payment):
+        """ Inserts a Payment with the others of its batch, returning once they are committed """
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = Batch()
+            batch.payments.append(payment)
+            if len(batch.payments) >= self.max_rows:
+                self._batch = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            try:
+                self.write(batch)
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        error = batch.errors.get(id(payment))
+        if error is not None:
+            raise error
+
+    def write(self, batch):
+        """ Commits a closed batch, one payment at a time if it fails as a whole """
+        BATCH_ROWS.observe(len(batch.payments))
+        try:
+            Payment.bulk_insert(batch.payments)
+            return
+        except Exception:
+            pass
+        for payment in batch.payments:
+            try:
+                Payment.bulk_insert([payment])
+            except Exception as e:
+                batch.errors[id(payment)] = e
+
+
+committer = GroupCommitter(float(os.getenv('GROUP_COMMIT_WINDOW_MS', '5')) / 1000,
+                           int(os.getenv('GROUP_COMMIT_MAX_ROWS', '100')))
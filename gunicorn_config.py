@@ -0,0 +1,63 @@
+"""
+Gunicorn Config
+
+Production launcher for the service: gunicorn -c gunicorn_config.py server:app
+
+The master imports the app once (preload_app) and forks the workers from it,
+so they share its memory pages and start without importing anything again.
+Connections opened in the master are discarded in each worker after the fork,
+since a socket shared by two processes corrupts both conversations.
+
+Settings come from the environment:
+    WEB_CONCURRENCY          worker processes (default: one per CPU core)
+    WORKER_CLASS             sync (default) or gevent for cooperative workers
+    WORKER_CONNECTIONS       concurrent requests per gevent worker (default 1000)
+    MAX_REQUESTS             requests served before a worker is replaced (default 10000)
+    MAX_REQUESTS_JITTER      random extra requests so workers do not restart together (default 1000)
+    WORKER_TIMEOUT           seconds a silent worker lives before it is killed (default 30)
+    GRACEFUL_TIMEOUT         seconds workers get to finish requests after SIGTERM (default 30)
+
+Each worker holds its own connection pool (DB_POOL_SIZE + DB_MAX_OVERFLOW),
+so size the database's connection limit for all workers together.
+
+Without CACHE_URL each worker would cache in its own memory and serve reads
+that another worker's writes made stale, so with several workers the
+in-process cache is turned off. The method id set stays on: an id it still
+holds after another worker deleted the method is caught by the foreign key.
+"""
+import os
+import multiprocessing
+
+bind = '0.0.0.0:%s' % os.getenv('PORT', '5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = os.getenv('WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', '1000'))
+preload_app = True
+
+# Runs before preload_app imports the cache, so the workers are forked without one
+in_process_cache = workers > 1 and not os.getenv('CACHE_URL')
+if in_process_cache:
+    os.environ['CACHE_TTL'] = '0'
+
+max_requests = int(os.getenv('MAX_REQUESTS', '10000'))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', '1000'))
+timeout = int(os.getenv('WORKER_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+accesslog = None
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    """ Warns that the in-process cache is off when several workers would each keep one """
+    if in_process_cache:
+        server.log.warning('Caching is off: %d workers need CACHE_URL to share a cache', workers)
+
+
+def post_fork(server, worker):
+    """ Drops any connection the worker inherited from the master """
+    from server import app, db
+    with app.app_context():
+        db.engine.dispose()
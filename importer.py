@@ -0,0 +1,171 @@
+"""
+Payment Import
+
+Loads payments from an NDJSON or CSV file, optionally gzipped, without
+holding the file in memory. Each row goes through Payment.deserialize and
+the method_id check, and the valid rows of a chunk are stored with one
+multi-row INSERT and one commit. Rejected rows are written to a rejects file
+with their line number and reason.
+
+The import's checkpoint is committed with each chunk, so running the same
+command again after an interruption resumes after the last stored chunk.
+
+Usage: python importer.py FILE [--format ndjson|csv] [--chunk-size N]
+                               [--name NAME] [--rejects FILE] [--restart]
+   or: FLASK_APP=server.py flask import-payments FILE [same options]
+"""
+import os
+import csv
+import gzip
+import json
+import time
+import logging
+import argparse
+import click
+from flask.cli import with_appcontext
+from models import Payment, ImportCheckpoint, DataValidationError
+
+# Rows validated and inserted per transaction
+IMPORT_CHUNK = 10000
+FORMATS = ('ndjson', 'csv')
+
+
+def guess_format(path):
+    """ Returns the format of a file from its extension, ignoring a trailing .gz """
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.endswith('.csv') else 'ndjson'
+
+def open_file(path):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def csv_value(value):
+    """ Returns a CSV field as an int when it is one, None when it is empty, else as text """
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def read_records(f, file_format):
+    """ Yields (line number, record, error) for each row of a file, where a bad row has its text and an error """
+    if file_format == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, dict((name, csv_value(value)) for name, value in row.items()), None
+        return
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, line.rstrip('\r\n'), 'Invalid JSON: %s' % e
+
+
+def validate_chunk(chunk):
+    """ Returns the Payments of the valid rows of a chunk of (line, record, error), and (line, reason, record) of the rest """
+    payments = []
+    rejects = []
+    for number, record, error in chunk:
+        try:
+            if error:
+                raise DataValidationError(error)
+            if not isinstance(record, dict):
+                raise DataValidationError('Invalid payment: each row must be an object')
+            payment = Payment().deserialize(record)
+            payment.id = None    # ids are always assigned by the database
+            payments.append((number, record, payment))
+        except DataValidationError as e:
+            rejects.append((number, e.message, record))
+    # One check of every method_id in the chunk, instead of a lookup per row
+    without_method = set(Payment.without_method([payment for _, _, payment in payments]))
+    for number, record, payment in payments:
+        if payment in without_method:
+            rejects.append((number, 'Invalid payment: payment method %s does not exist' % payment.method_id, record))
+    rejects.sort(key=lambda reject: reject[0])
+    return [payment for _, _, payment in payments if payment not in without_method], rejects
+
+
+def store_chunk(chunk, rejects_file, name, line, totals):
+    """
+    Stores the valid rows of a chunk and the checkpoint after it in one commit.
+    The rejects are written first, so an interruption can repeat them but not lose them.
+    """
+    payments, rejects = validate_chunk(chunk)
+    for number, message, record in rejects:
+        rejects_file.write(json.dumps({'line': number, 'message': message, 'record': record}, default=str) + '\n')
+    rejects_file.flush()
+    if payments:
+        Payment.bulk_insert(payments, commit=False)
+    ImportCheckpoint.save(name, line, totals['inserted'] + len(payments), totals['rejected'] + len(rejects))
+    totals['inserted'] += len(payments)
+    totals['rejected'] += len(rejects)
+
+
+def import_payments(path, file_format=None, chunk_size=IMPORT_CHUNK, name=None, rejects_path=None,
+                    restart=False):
+    """ Imports the payments of a file, resuming from its checkpoint, and returns the totals """
+    file_format = file_format or guess_format(path)
+    name = name or os.path.abspath(path)
+    rejects_path = rejects_path or path + '.rejects.ndjson'
+    if restart:
+        ImportCheckpoint.remove(name)
+    checkpoint = ImportCheckpoint.find(name)
+    resume_after = checkpoint.line if checkpoint else 0
+    totals = {'inserted': checkpoint.inserted if checkpoint else 0,
+              'rejected': checkpoint.rejected if checkpoint else 0}
+    if resume_after:
+        logging.info("Resuming %s after line %d", path, resume_after)
+
+    start = time.time()
+    read = 0
+    with open_file(path) as f, open(rejects_path, 'a' if resume_after else 'w') as rejects_file:
+        chunk = []
+        number = resume_after
+        for row in read_records(f, file_format):
+            number = row[0]
+            if number <= resume_after:
+                continue
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                read += len(chunk)
+                store_chunk(chunk, rejects_file, name, number, totals)
+                chunk = []
+                logging.info("Line %d: %d payments imported, %d rejected (%.0f rows/s)", number,
+                             totals['inserted'], totals['rejected'], read / max(time.time() - start, 1e-6))
+        if chunk:
+            read += len(chunk)
+            store_chunk(chunk, rejects_file, name, number, totals)
+    logging.info("Imported %d payments from %s, rejected %d (see %s), in %.1fs", totals['inserted'], path,
+                 totals['rejected'], rejects_path, time.time() - start)
+    return totals
+
+
+@click.command('import-payments')
+@click.argument('path')
+@click.option('--format', 'file_format', type=click.Choice(FORMATS), help='Defaults to the file extension')
+@click.option('--chunk-size', default=IMPORT_CHUNK, help='Rows per INSERT and commit')
+@click.option('--name', help='Key of the checkpoint, defaults to the absolute path')
+@click.option('--rejects', 'rejects_path', help='Where rejected rows go, defaults to PATH.rejects.ndjson')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint and start from the top')
+@with_appcontext
+def import_command(path, file_format, chunk_size, name, rejects_path, restart):
+    """ Imports payments from an NDJSON or CSV file """
+    logging.basicConfig(level=logging.INFO)
+    import_payments(path, file_format, chunk_size, name, rejects_path, restart)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import payments from an NDJSON or CSV file')
+    parser.add_argument('path')
+    parser.add_argument('--format', dest='file_format', choices=FORMATS)
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK)
+    parser.add_argument('--name')
+    parser.add_argument('--rejects', dest='rejects_path')
+    parser.add_argument('--restart', action='store_true')
+    args = parser.parse_args()
+    from server import app
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        import_payments(**vars(args))
@@ -0,0 +1,114 @@
+"""
+Instrumentation
+
+Records where the time of each request goes: its latency by route and status
+code, how many SQL statements it ran and how long they took, and how long it
+spent encoding JSON, apart from the database time. Everything is reported
+through the metrics registry at GET /metrics.
+
+The latency of a streamed response includes sending its whole body, since the
+request only ends once the stream is exhausted. Set REQUEST_METRICS=False to
+leave the hooks out.
+"""
+import os
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import metrics
+
+# Statements per request, so an N+1 shows up in the upper buckets
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+
+REQUEST_SECONDS = metrics.Histogram(
+    'http_request_duration_seconds', 'Time to serve a request, including a streamed body')
+REQUEST_QUERIES = metrics.Histogram(
+    'http_request_queries', 'SQL statements run by a request', buckets=QUERY_COUNT_BUCKETS)
+REQUEST_QUERY_SECONDS = metrics.Histogram(
+    'http_request_query_seconds', 'Time a request spent executing SQL statements')
+REQUEST_SERIALIZE_SECONDS = metrics.Histogram(
+    'http_request_serialize_seconds', 'Time a request spent encoding JSON')
+QUERY_SECONDS = metrics.Histogram(
+    'db_query_duration_seconds', 'Time to execute one SQL statement')
+
+
+def enabled():
+    """ Returns True unless REQUEST_METRICS turns the request hooks off """
+    return os.getenv('REQUEST_METRICS', 'True') == 'True'
+
+
+def record_serialization(seconds):
+    """ Adds time spent encoding JSON to the current request """
+    if has_request_context() and hasattr(g, 'serialize_seconds'):
+        g.serialize_seconds += seconds
+
+
+def timed_encoder(encoder):
+    """ Returns a subclass of a JSONEncoder that records the time spent in encode() """
+    class TimedJSONEncoder(encoder):
+        def encode(self, o):
+            start = time.time()
+            try:
+                return super(TimedJSONEncoder, self).encode(o)
+            finally:
+                record_serialization(time.time() - start)
+    return TimedJSONEncoder
+
+
+######################################################################
+# SQLAlchemy events
+######################################################################
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.time() - conn.info['query_start'].pop()
+    QUERY_SECONDS.observe(seconds, operation=statement.split(None, 1)[0].upper())
+    if has_request_context() and hasattr(g, 'query_count'):
+        g.query_count += 1
+        g.query_seconds += seconds
+
+def _handle_error(exception_context):
+    starts = exception_context.connection.info.get('query_start') if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+
+######################################################################
+# Request hooks
+######################################################################
+def _before_request():
+    g.request_start = time.time()
+    g.query_count = 0
+    g.query_seconds = 0.0
+    g.serialize_seconds = 0.0
+
+def _after_request(response):
+    g.status_code = response.status_code
+    return response
+
+def _teardown_request(exception):
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return
+    del g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    code = 500 if exception else getattr(g, 'status_code', 500)
+    REQUEST_SECONDS.observe(time.time() - start, route=route, method=request.method, status=code)
+    REQUEST_QUERIES.observe(g.query_count, route=route, method=request.method)
+    REQUEST_QUERY_SECONDS.observe(g.query_seconds, route=route, method=request.method)
+    REQUEST_SERIALIZE_SECONDS.observe(g.serialize_seconds, route=route, method=request.method)
+
+
+def init_app(app):
+    """ Times the requests of app and the SQL statements of every engine """
+    if not enabled():
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    app.json_encoder = timed_encoder(app.json_encoder)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
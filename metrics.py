@@ -0,0 +1,121 @@
+"""
+Metrics
+
+A small registry of counters, gauges and histograms that GET /metrics renders
+in the Prometheus text exposition format. Values are kept per process, so
+each worker reports its own and the scraper sums them.
+"""
+import threading
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+
+def _label_key(labels):
+    """ Returns a hashable, ordered key for a set of label values """
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    """ Formats label pairs as {name="value",...}, or nothing when there are none """
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{%s}' % ','.join(escaped)
+
+def _format_value(value):
+    """ Formats a sample value the way Prometheus expects """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """ Base class for a named metric that registers itself for rendering """
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        """ Returns (name, label key, extra labels, value) for each sample """
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for name, key, extra, value in self.samples():
+            lines.append('%s%s %s' % (name, _format_labels(key, extra), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """ A value that only goes up, e.g. a count of requests """
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        super(Counter, self).__init__(name, description)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """ A value read from a function each time the metrics are rendered """
+    kind = 'gauge'
+
+    def __init__(self, name, description, function):
+        super(Gauge, self).__init__(name, description)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if value is None:
+            return []
+        return [(self.name, (), (), value)]
+
+
+class Histogram(Metric):
+    """ Counts observations, e.g. durations in seconds, into cumulative buckets """
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket', key, (('le', _format_value(bound)),), count))
+                samples.append((self.name + '_sum', key, (), total))
+                samples.append((self.name + '_count', key, (), counts[-1]))
+        return samples
+
+
+def render():
+    """ Returns every registered metric in the text exposition format """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
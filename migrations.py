@@ -0,0 +1,106 @@
+"""
+Schema Migrations
+
+db.create_all() only creates the tables that are missing, so a column or
+index added to a model never reaches a database where the table already
+exists. upgrade() brings such a database in line with the models and is safe
+to run repeatedly.
+
+Usage: python migrations.py, or FLASK_APP=server.py flask init-db
+"""
+import logging
+from sqlalchemy import inspect, select, exists, func, and_
+from sqlalchemy.schema import CreateColumn, AddConstraint
+from database import db
+
+
+def add_missing_columns():
+    """ Adds every column declared on the models that the database lacks """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                logging.info("Adding column %s to %s", column.name, table.name)
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                db.engine.execute('ALTER TABLE %s ADD COLUMN %s' % (table.name, ddl))
+
+
+def add_missing_indexes():
+    """ Creates every index declared on the models that the database lacks """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.info("Creating index %s on %s", index.name, table.name)
+                index.create(bind=db.engine)
+
+
+def count_orphans(constraint):
+    """ Returns how many rows of a foreign key's table refer to a parent row that does not exist """
+    parent = constraint.referred_table
+    refers = and_(*[element.column == element.parent for element in constraint.elements])
+    has_parent = exists(select([1]).select_from(parent).where(refers))
+    not_null = and_(*[element.parent.isnot(None) for element in constraint.elements])
+    query = select([func.count()]).select_from(constraint.table).where(and_(not_null, ~has_parent))
+    return db.engine.execute(query).scalar()
+
+
+def add_missing_foreign_keys():
+    """
+    Adds every foreign key declared on the models that the database lacks. A
+    foreign key that existing rows would break is left out with a warning, so
+    the service still starts; once those rows are fixed, the next run adds it.
+    SQLite cannot add a constraint to an existing table, so it is skipped there.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set((tuple(fk['constrained_columns']), fk['referred_table'])
+                       for fk in inspector.get_foreign_keys(table.name))
+        for constraint in table.foreign_key_constraints:
+            if (tuple(constraint.column_keys), constraint.referred_table.name) in existing:
+                continue
+            orphans = count_orphans(constraint)
+            if orphans:
+                logging.warning("Not adding foreign key %s to %s: %d rows refer to missing %s rows",
+                                constraint.name, table.name, orphans, constraint.referred_table.name)
+                continue
+            logging.info("Adding foreign key %s to %s", constraint.name, table.name)
+            db.engine.execute(AddConstraint(constraint))
+
+
+def fill_payment_summaries(created):
+    """ Counts the existing Payments into the summary tables when they were just created """
+    from models import PaymentSummary
+    if PaymentSummary.__tablename__ in created:
+        logging.info("Counting existing payments into %s", PaymentSummary.__tablename__)
+        PaymentSummary.rebuild()
+
+
+def fill_payment_events(created):
+    """ Logs the creation of the existing Payments when the event log was just created """
+    from models import PaymentEvent
+    if PaymentEvent.__tablename__ in created:
+        logging.info("Logging existing payments into %s", PaymentEvent.__tablename__)
+        PaymentEvent.backfill()
+
+
+def upgrade():
+    """ Creates missing tables, then adds what is missing to existing ones """
+    created = [table.name for table in db.metadata.sorted_tables if not db.engine.has_table(table.name)]
+    db.create_all()
+    add_missing_columns()
+    add_missing_indexes()
+    add_missing_foreign_keys()
+    fill_payment_summaries(created)
+    fill_payment_events(created)
+
+
+if __name__ == "__main__":
+    from server import app
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        upgrade()
@@ -1,7 +1,34 @@
-from server import db, DataValidationError
+import os
+import itertools
+from datetime import datetime, timedelta
+from database import db
 from enum import Enum
 from flask_sqlalchemy import SQLAlchemy
-from flask import url_for
+from flask import url_for, abort
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.dialects import mysql
+from cache import cache, method_ids
+
+# Rows per multi-row INSERT statement, which keeps each one well under max_allowed_packet.
+# A power of two, so any batch splits into a handful of statement sizes that compile once.
+BULK_INSERT_CHUNK = 1024
+BULK_INSERT_COLUMNS = ('user_id', 'order_id', 'status', 'method_id')
+# Fields a sparse update may leave out, and what they hold
+PAYMENT_FIELDS = ('user_id', 'order_id', 'status', 'method_id')
+PAYMENT_METHOD_FIELDS = ('method_type', 'is_default')
+_bulk_insert_statements = {}
+
+
+class DataValidationError(ValueError):
+    pass
+
+
+class PaymentTransitionError(Exception):
+    """ A Payment was asked to move to a status it may not move to from its own """
+    pass
 
 
 class PaymentStatus(Enum):
@@ -9,35 +36,191 @@ class PaymentStatus(Enum):
     PROCESSING = 2
     PAID = 3
 
+# The statuses a Payment may move to from each status
+PAYMENT_TRANSITIONS = {
+    PaymentStatus.UNPAID: (PaymentStatus.PROCESSING,),
+    PaymentStatus.PROCESSING: (PaymentStatus.PAID, PaymentStatus.UNPAID),
+    PaymentStatus.PAID: (),
+}
+
+def transition_sources(new_status):
+    """ Returns the statuses a Payment may move to new_status from """
+    return [old for old, targets in PAYMENT_TRANSITIONS.items() if new_status in targets]
+
+def check_transition(old_status, new_status):
+    """ Raises PaymentTransitionError unless a Payment may move from old_status to new_status """
+    if old_status is not None and new_status != old_status and new_status not in PAYMENT_TRANSITIONS[old_status]:
+        raise PaymentTransitionError('Invalid status change: cannot move from %s to %s'
+                                     % (old_status.name, new_status.name if new_status else None))
+
 class PaymentMethodType(Enum):
     __order__ ='CREDIT DEBIT PAYPAL'
     CREDIT = 1
     DEBIT = 2
     PAYPAL = 3
 
+# Enum columns store the member name, and the API returns the member value
+STATUS_VALUES = dict((member.name, member.value) for member in PaymentStatus)
+METHOD_TYPE_VALUES = dict((member.name, member.value) for member in PaymentMethodType)
+
 class Payment(db.Model):
+    # Each filter of GET /payments leads one index, so lookups by user, order or
+    # method are index seeks. status comes second since it is the usual extra filter.
+    __table_args__ = (
+        db.Index('ix_payment_user_id_status', 'user_id', 'status'),
+        db.Index('ix_payment_order_id_status', 'order_id', 'status'),
+        db.Index('ix_payment_method_id_status', 'method_id', 'status'),
+        db.Index('ix_payment_status', 'status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, nullable=False)
+    user_id = db.column_property(db.Column(db.Integer, nullable=False), active_history=True)
     order_id = db.Column(db.Integer, nullable=False)
-    status = db.Column(db.Enum(PaymentStatus))
-    method_id = db.Column(db.Integer, nullable=False)
-    # method_id = db.Column(db.Integer, db.ForeignKey('payment_method.id'), nullable=False)
-    # method = db.relationship('PaymentMethod', backref=db.backref('payments', lazy=True))
+    # Loaded before they are overwritten, so an UPDATE knows which summary counts to move
+    status = db.column_property(db.Column(db.Enum(PaymentStatus)), active_history=True)
+    # ix_payment_method_id_status leads with method_id, so it also serves the foreign key
+    method_id = db.Column(db.Integer, db.ForeignKey('payment_method.id', name='fk_payment_method_id'),
+                          nullable=False)
+    # passive_deletes leaves deleting a method that is still in use for the database to refuse
+    method = db.relationship('PaymentMethod', backref=db.backref('payments', lazy=True, passive_deletes=True))
+    # Bumped on every UPDATE, which only applies while the row still has the version
+    # that was read. It also makes the ETag of the Payment.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return '<Payment %d>' % self.id
 
-    def save(self):
-        """ Saves an existing Payment in the database """
+    def save(self, commit=True):
+        """ Saves an existing Payment in the database, or only flushes it when commit is False """
         # if the id is None it hasn't been added to the database
         if not self.id:
             db.session.add(self)
-        db.session.commit()
+        # Kept aside, since after a failed flush the attribute reloads the old method
+        method_id = self.method_id
+        try:
+            if not commit:
+                db.session.flush()
+                return
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            _raise_missing_method([method_id])
+            raise
+        cache.delete(Payment.cache_key(self.id))
 
     def delete(self):
         """ Delete a Payment from the database"""
         db.session.delete(self)
         db.session.commit()
+        cache.delete(Payment.cache_key(self.id))
+
+    @staticmethod
+    def bulk_insert(payments, commit=True):
+        """
+        Inserts Payments in one transaction and returns their new ids. With
+        commit False the transaction is left open for the caller to commit.
+
+        Each chunk of rows goes in as one multi-row INSERT, so the ids are worked
+        out from the id the database reports for the statement. This relies on a
+        multi-row INSERT getting evenly spaced auto-increment ids, as InnoDB does
+        in its default "consecutive" lock mode and SQLite always does. The spacing
+        is MySQL's auto_increment_increment, which ClearDB sets to 10.
+        """
+        connection = db.session.connection()
+        ids = []
+        start = 0
+        try:
+            increment = _id_increment(connection)
+            for size in _chunk_sizes(len(payments)):
+                chunk = payments[start:start + size]
+                start += size
+                params = {}
+                for n, payment in enumerate(chunk):
+                    for name in BULK_INSERT_COLUMNS:
+                        params['%s_%d' % (name, n)] = getattr(payment, name)
+                statement = _bulk_insert_statement(connection.dialect, size)
+                chunk_ids = _inserted_ids(connection.execute(statement, params), size, increment)
+                for payment, id in zip(chunk, chunk_ids):
+                    payment.id = id
+                    payment.version = 1
+                    ids.append(id)
+            add_to_summaries(connection, [(payment.user_id, payment.status, 1) for payment in payments])
+            PaymentEvent.log(connection, [(payment.id, None, payment.status) for payment in payments])
+            if commit:
+                db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            _raise_missing_method([payment.method_id for payment in payments])
+            raise
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
+
+    @staticmethod
+    def transition(ids, new_status):
+        """
+        Moves the Payments with the given ids to a new status in one UPDATE
+
+        Only Payments whose status may legally move to new_status are changed.
+        Returns the ids that were updated, and a dict of the ids that were
+        skipped along with the reason.
+        """
+        sources = transition_sources(new_status)
+        try:
+            current = dict((id, (status, user_id)) for id, status, user_id in
+                           db.session.query(Payment.id, Payment.status, Payment.user_id)
+                           .filter(Payment.id.in_(ids)).with_for_update())
+            updated = []
+            skipped = {}
+            for payment_id in ids:
+                if payment_id not in current:
+                    skipped[payment_id] = 'not found'
+                elif current[payment_id][0] not in sources:
+                    skipped[payment_id] = 'cannot move from %s to %s' % (current[payment_id][0].name, new_status.name)
+                else:
+                    updated.append(payment_id)
+            if updated:
+                Payment.query.filter(Payment.id.in_(updated), Payment.status.in_(sources)) \
+                    .update({Payment.status: new_status, Payment.version: Payment.version + 1},
+                            synchronize_session=False)
+                moves = [current[payment_id] for payment_id in updated]
+                add_to_summaries(db.session.connection(), [(user_id, old, -1) for old, user_id in moves] +
+                                 [(user_id, new_status, 1) for _, user_id in moves])
+                PaymentEvent.log(db.session.connection(),
+                                 [(payment_id, current[payment_id][0], new_status) for payment_id in updated])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cache.delete(*[Payment.cache_key(payment_id) for payment_id in updated])
+        return updated, skipped
+
+    @staticmethod
+    def transition_where(query, new_status):
+        """ Moves every Payment of a query that may legally move to new_status, and returns the count """
+        sources = transition_sources(new_status)
+        if not sources:
+            return 0
+        query = query.filter(Payment.status.in_(sources))
+        try:
+            # Counted per user and status first, under the same row locks, for the summaries
+            moves = query.with_entities(Payment.user_id, Payment.status, db.func.count()) \
+                .group_by(Payment.user_id, Payment.status).with_for_update().all()
+            PaymentEvent.log_moves(db.session.connection(), query, new_status)
+            count = query.update({Payment.status: new_status, Payment.version: Payment.version + 1},
+                                 synchronize_session=False)
+            add_to_summaries(db.session.connection(), [(user_id, old, -n) for user_id, old, n in moves] +
+                             [(user_id, new_status, n) for user_id, _, n in moves])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        # The ids that moved are not known, so drop every cached Payment
+        cache.delete_prefix('payment:')
+        return count
 
     @staticmethod
     def remove_all():
@@ -45,7 +228,11 @@ class Payment(db.Model):
         #db.drop_all();
       #  db.create_all();
         Payment.query.delete()
+        PaymentEvent.query.delete()
+        PaymentSummary.query.delete()
+        PaymentTotal.query.delete()
         db.session.commit()
+        cache.delete_prefix('payment:')
 
     @staticmethod
     def all():
@@ -62,6 +249,27 @@ class Payment(db.Model):
         """ Find a Payment by its id """
         return Payment.query.get_or_404(payment_id)
 
+    @staticmethod
+    def cache_key(payment_id):
+        """ Returns the cache key of a Payment """
+        return 'payment:%d' % payment_id
+
+    @staticmethod
+    def find_serialized(payment_id, with_method=False):
+        """ Find a serialized Payment by its id, through the cache unless its method is embedded """
+        if with_method:
+            query = Payment.join_method(Payment.query.filter(Payment.id == payment_id))
+            data = next(Payment.rows(query, with_method=True), None)
+            if data is None:
+                abort(404)
+            return data
+        key = Payment.cache_key(payment_id)
+        data = cache.get(key)
+        if data is None:
+            data = Payment.find_or_404(payment_id).serialize()
+            cache.set(key, data)
+        return data
+
     @staticmethod
     def find_by_user(user_id):
         """ Find a Payment/s by its user id"""
@@ -72,12 +280,95 @@ class Payment(db.Model):
         """ Find a Payment/s by its order id"""
         return Payment.query.filter(Payment.order_id == order_id)
 
+    @staticmethod
+    def find_by_filters(user_id=None, order_id=None, status=None, method_id=None):
+        """ Find Payments matching every filter that is given """
+        query = Payment.query
+        if user_id is not None:
+            query = query.filter(Payment.user_id == user_id)
+        if order_id is not None:
+            query = query.filter(Payment.order_id == order_id)
+        if status is not None:
+            query = query.filter(Payment.status == status)
+        if method_id is not None:
+            query = query.filter(Payment.method_id == method_id)
+        return query
+
+    @staticmethod
+    def join_method(query):
+        """
+        Joins each Payment of a query to its Payment Method, for versions() and
+        rows() with with_method. It has to come before any LIMIT or OFFSET.
+        """
+        return query.outerjoin(Payment.method)
+
+    @staticmethod
+    def versions(query, with_method=False):
+        """
+        Returns the (id, version) of every Payment of a query, without loading the
+        Payments, followed by the columns of its method when that is embedded
+        """
+        if not with_method:
+            return query.with_entities(Payment.id, Payment.version).yield_per(BULK_INSERT_CHUNK)
+        columns = query.with_entities(Payment.id, Payment.version, PaymentMethod.id, PaymentMethod.version)
+        return columns.yield_per(BULK_INSERT_CHUNK)
+
+    @staticmethod
+    def rows(query, with_method=False):
+        """
+        Returns every Payment of a query in serialized form, built straight from
+        the selected columns instead of loading a Payment for each row. With
+        with_method, its Payment Method is embedded, read through the JOIN that
+        join_method added to the query.
+        """
+        columns = [Payment.id, Payment.user_id, Payment.order_id,
+                   db.type_coerce(Payment.status, db.String), Payment.method_id, Payment.version]
+        if not with_method:
+            for id, user_id, order_id, status, method_id, version in \
+                    query.with_entities(*columns).yield_per(BULK_INSERT_CHUNK):
+                yield {"id": id, "user_id": user_id, "order_id": order_id,
+                       "status": STATUS_VALUES[status], "method_id": method_id, "version": version}
+            return
+        columns += [db.type_coerce(PaymentMethod.method_type, db.String), PaymentMethod.is_default,
+                    PaymentMethod.version]
+        rows = query.with_entities(*columns).yield_per(BULK_INSERT_CHUNK)
+        for id, user_id, order_id, status, method_id, version, method_type, is_default, method_version in rows:
+            method = None
+            if method_type is not None:
+                method = {"id": method_id, "method_type": METHOD_TYPE_VALUES[method_type],
+                          "is_default": is_default, "version": method_version}
+            yield {"id": id, "user_id": user_id, "order_id": order_id, "status": STATUS_VALUES[status],
+                   "method_id": method_id, "version": version, "method": method}
+
+    @staticmethod
+    def etag(data):
+        """ Returns the strong ETag of a serialized Payment, covering its method when that is embedded """
+        etag = '%d-%d' % (data['id'], data['version'])
+        if 'method' in data:
+            etag += '-m%d' % (data['method'] or {}).get('version', 0)
+        return etag
+
+    @staticmethod
+    def etag_key(data):
+        """ Returns what identifies the state of a serialized Payment in the ETag of a listing """
+        if 'method' not in data:
+            return (data['id'], data['version'])
+        method = data['method'] or {}
+        return (data['id'], data['version'], method.get('id'), method.get('version'))
+
+    @staticmethod
+    def keyset(query, after=None):
+        """ Orders a Payment query by id, keeping only the Payments after the cursor id """
+        if after is not None:
+            query = query.filter(Payment.id > after)
+        return query.order_by(Payment.id)
+
     def self_url(self):
-        return url_for('get_payment', id=self.id, _external=True)
+        return url_for('payments.get_payment', id=self.id, _external=True)
 
     def serialize(self):
         return {"id": self.id, "user_id": self.user_id, "order_id": self.order_id,
-                "status": self.status.value, "method_id": self.method_id}
+                "status": self.status.value, "method_id": self.method_id, "version": self.version}
 
     def deserialize(self, data):
         try:
@@ -94,11 +385,193 @@ class Payment(db.Model):
             raise DataValidationError('Invalid payment: body of request contained bad or no data: %s' % e.message)
         return self
 
+    @staticmethod
+    def changes(data):
+        """ Returns the columns set by a sparse update, validating only the fields it has """
+        changes = _changed_fields(data, PAYMENT_FIELDS, 'payment')
+        for name in ('user_id', 'order_id', 'method_id'):
+            if name in changes and not _is_id(changes[name]):
+                raise DataValidationError('Invalid payment: %s must be an integer' % name)
+        if 'status' in changes:
+            try:
+                changes['status'] = PaymentStatus(changes['status'])
+            except ValueError:
+                raise DataValidationError('Invalid payment: %s is not a payment status' % changes['status'])
+        if 'method_id' in changes and PaymentMethod.missing_ids([changes['method_id']]):
+            raise DataValidationError('Invalid payment: payment method %s does not exist' % changes['method_id'])
+        return changes
+
+    @staticmethod
+    def patch(payment_id, changes, version=None, returning=True):
+        """
+        Writes only the given columns of a Payment with one UPDATE, without loading
+        it first, and returns it serialized (or None when returning is False).
+        With a version the UPDATE only applies while the row still has it.
+
+        A change of status or user_id reads the old ones first, locking the row,
+        since the summaries have to move the Payment from them.
+        """
+        table = Payment.__table__
+        try:
+            connection = db.session.connection()
+            old = None
+            if 'status' in changes or 'user_id' in changes:
+                old = db.session.query(Payment.user_id, Payment.status) \
+                    .filter(Payment.id == payment_id).with_for_update().first()
+                if old is None:
+                    abort(404)
+            where = refusal = None
+            new_status = changes.get('status', old.status if old else None)
+            if old is not None and new_status != old.status:
+                # The database only makes the move from a status it may be made from
+                where = table.c.status.in_(transition_sources(new_status))
+                refusal = PaymentTransitionError('Invalid status change: cannot move from %s to %s'
+                                                 % (old.status.name, new_status.name))
+            columns = [table.c.id, table.c.user_id, table.c.order_id,
+                       db.type_coerce(table.c.status, db.String), table.c.method_id, table.c.version]
+            values = dict(changes, version=table.c.version + 1)
+            row = _update_row(connection, table, payment_id, values, version, columns if returning else None,
+                              where, refusal)
+            if old is not None:
+                add_to_summaries(connection, [(old.user_id, old.status, -1),
+                                              (changes.get('user_id', old.user_id), new_status, 1)])
+            if where is not None:
+                PaymentEvent.log(connection, [(payment_id, old.status, new_status)])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if 'method_id' in changes:
+                _raise_missing_method([changes['method_id']])
+            raise
+        except Exception:
+            db.session.rollback()
+            raise
+        cache.delete(Payment.cache_key(payment_id))
+        if not returning:
+            return None
+        if row is None:
+            return Payment.find_serialized(payment_id)
+        id, user_id, order_id, status, method_id, version = row
+        return {"id": id, "user_id": user_id, "order_id": order_id, "status": STATUS_VALUES[status],
+                "method_id": method_id, "version": version}
+
+    def check_method(self):
+        """ Raises DataValidationError unless method_id is the id of a Payment Method """
+        if Payment.without_method([self]):
+            raise DataValidationError('Invalid payment: payment method %s does not exist' % self.method_id)
+
+    @staticmethod
+    def without_method(payments):
+        """ Returns the Payments whose method_id is not the id of a Payment Method, with one query at most """
+        missing = PaymentMethod.missing_ids([p.method_id for p in payments if _is_id(p.method_id)])
+        return [p for p in payments if not _is_id(p.method_id) or p.method_id in missing]
+
+
+def _is_id(value):
+    """ Returns True when value is an integer that could be a row id """
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def _raise_missing_method(ids):
+    """
+    Called on an IntegrityError from writing Payments with these method ids. The
+    cached ids let a deleted Payment Method through, so they are forgotten and
+    checked again, raising DataValidationError for one that does not exist.
+    """
+    ids = [id for id in ids if _is_id(id)]
+    method_ids.discard(*ids)
+    missing = PaymentMethod.missing_ids(ids)
+    if missing:
+        raise DataValidationError('Invalid payment: payment method %s does not exist'
+                                  % ', '.join(str(id) for id in sorted(missing)))
+
+def _changed_fields(data, fields, name):
+    """ Returns the fields a sparse update body sets, refusing one that sets none or an unknown one """
+    if not isinstance(data, dict):
+        raise DataValidationError('Invalid %s: body of request contained bad or no data' % name)
+    unknown = sorted(set(data) - set(fields) - set(['id', 'version']))
+    if unknown:
+        raise DataValidationError('Invalid %s: unknown field %s' % (name, ', '.join(unknown)))
+    changes = dict((field, data[field]) for field in fields if field in data)
+    if not changes:
+        raise DataValidationError('Invalid %s: nothing to update' % name)
+    return changes
+
+def _update_row(connection, table, id, values, version=None, columns=None, where=None, refusal=None):
+    """
+    Runs the UPDATE of a sparse update and returns the columns of the row it
+    wrote where the database supports RETURNING, else None. Aborts with 404 when
+    there is no such row, and raises StaleDataError when it has another version,
+    or refusal when the row fails the extra where condition.
+    """
+    condition = table.c.id == id
+    if version is not None:
+        condition = db.and_(condition, table.c.version == version)
+    if where is not None:
+        condition = db.and_(condition, where)
+    statement = table.update().where(condition).values(values)
+    # MySQL and SQLite have no RETURNING, so the caller reads the row back instead
+    returning = columns is not None and connection.dialect.implicit_returning
+    if returning:
+        statement = statement.returning(*columns)
+    result = connection.execute(statement)
+    row = result.first() if returning else None
+    if result.rowcount == 0 or (returning and row is None):
+        # Only a failed update pays for telling a missing row from a changed one
+        current = connection.execute(db.select([table.c.version]).where(table.c.id == id)).first()
+        if current is None:
+            abort(404)
+        if where is not None and (version is None or current.version == version):
+            raise refusal
+        raise StaleDataError('%s %d has another version than %d' % (table.name, id, version))
+    return row
+
+def _chunk_sizes(count):
+    """ Splits count rows into BULK_INSERT_CHUNK sized chunks and power of two remainders """
+    while count:
+        size = BULK_INSERT_CHUNK
+        while size > count:
+            size //= 2
+        yield size
+        count -= size
+
+def _bulk_insert_statement(dialect, size):
+    """ Returns a compiled INSERT of size Payment rows, compiling it once per dialect and size """
+    key = (dialect.name, size)
+    if key not in _bulk_insert_statements:
+        table = Payment.__table__
+        rows = [dict((name, db.bindparam('%s_%d' % (name, n), type_=table.c[name].type))
+                     for name in BULK_INSERT_COLUMNS) for n in range(size)]
+        _bulk_insert_statements[key] = table.insert().values(rows).compile(dialect=dialect)
+    return _bulk_insert_statements[key]
+
+def _id_increment(connection):
+    """ Returns the step between auto-increment ids, read once per MySQL connection """
+    if connection.dialect.name != 'mysql':
+        return 1
+    # info lives as long as the DBAPI connection, across checkouts from the pool
+    info = connection.connection.info
+    if 'auto_increment_increment' not in info:
+        info['auto_increment_increment'] = int(connection.execute('SELECT @@auto_increment_increment').scalar())
+    return info['auto_increment_increment']
+
+def _inserted_ids(result, count, increment=1):
+    """ Returns the ids given to the rows of a multi-row INSERT """
+    # MySQL reports the first id generated by the statement, SQLite the last one
+    first_id = result.lastrowid
+    if result.dialect.name == 'sqlite':
+        first_id -= (count - 1) * increment
+    return [first_id + offset * increment for offset in range(count)]
+
 
 class PaymentMethod(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     method_type = db.Column(db.Enum(PaymentMethodType))
-    is_default = db.Column(db.Boolean, default=False)
+    is_default = db.Column(db.Boolean, default=False, index=True)
+    # Bumped on every UPDATE, which only applies while the row still has the version
+    # that was read, as for a Payment
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def save(self):
         """ Saves an existing Payment Method in the database """
@@ -106,6 +579,8 @@ class PaymentMethod(db.Model):
         if not self.id:
             db.session.add(self)
         db.session.commit()
+        cache.delete(PaymentMethod.cache_key(self.id))
+        method_ids.add(self.id)
 
     @staticmethod
     def find(id):
@@ -116,6 +591,8 @@ class PaymentMethod(db.Model):
         """ Delete a Payment Methodfrom the database"""
         db.session.delete(self)
         db.session.commit()
+        cache.delete(PaymentMethod.cache_key(self.id))
+        method_ids.discard(self.id)
 
     @staticmethod
     def all():
@@ -127,11 +604,108 @@ class PaymentMethod(db.Model):
         """ Find a Payment by its id """
         return PaymentMethod.query.get_or_404(payment_id)
 
+    @staticmethod
+    def cache_key(id):
+        """ Returns the cache key of a Payment Method """
+        return 'payment_method:%d' % id
+
+    @staticmethod
+    def find_serialized(id):
+        """ Find a serialized Payment Method by its id, through the cache """
+        key = PaymentMethod.cache_key(id)
+        data = cache.get(key)
+        if data is None:
+            data = PaymentMethod.find_or_404(id).serialize()
+            cache.set(key, data)
+        return data
+
+    @staticmethod
+    def etag(data):
+        """ Returns the strong ETag of a serialized Payment Method """
+        return '%d-%d' % (data['id'], data['version'])
+
+    @staticmethod
+    def rows(query):
+        """ Returns every Payment Method of a query in serialized form, without loading them """
+        columns = query.with_entities(PaymentMethod.id,
+                                      db.type_coerce(PaymentMethod.method_type, db.String),
+                                      PaymentMethod.is_default, PaymentMethod.version)
+        for id, method_type, is_default, version in columns.yield_per(BULK_INSERT_CHUNK):
+            yield {"id": id, "method_type": METHOD_TYPE_VALUES[method_type], "is_default": is_default,
+                   "version": version}
+
+    @staticmethod
+    def missing_ids(ids):
+        """ Returns the ids no Payment Method has, querying once for those not known to exist """
+        unknown = method_ids.missing(ids)
+        if not unknown:
+            return set()
+        # Without autoflush, so a Payment being validated is not written before its check
+        with db.session.no_autoflush:
+            query = db.session.query(PaymentMethod.id).filter(PaymentMethod.id.in_(unknown))
+            found = set(id for id, in query)
+        method_ids.add(*found)
+        return unknown - found
+
+    @staticmethod
+    def changes(data):
+        """ Returns the columns set by a sparse update, validating only the fields it has """
+        changes = _changed_fields(data, PAYMENT_METHOD_FIELDS, 'payment method')
+        if 'method_type' in changes:
+            try:
+                changes['method_type'] = PaymentMethodType(changes['method_type'])
+            except ValueError:
+                raise DataValidationError('Invalid payment method: %s is not a method type' % changes['method_type'])
+        if 'is_default' in changes and not isinstance(changes['is_default'], bool):
+            raise DataValidationError('Invalid payment method: is_default must be true or false')
+        return changes
+
+    @staticmethod
+    def patch(id, changes, version=None, returning=True):
+        """
+        Writes only the given columns of a Payment Method with one UPDATE, without
+        loading it first, and returns it serialized (or None when returning is False).
+        Making it the default clears the flag of the others in the same transaction.
+        """
+        table = PaymentMethod.__table__
+        try:
+            connection = db.session.connection()
+            columns = [table.c.id, db.type_coerce(table.c.method_type, db.String), table.c.is_default,
+                       table.c.version]
+            row = _update_row(connection, table, id, dict(changes, version=table.c.version + 1),
+                              version, columns if returning else None)
+            if changes.get('is_default'):
+                # As in set_default, only the methods whose flag changes get a new version
+                others = db.and_(table.c.id != id, db.or_(table.c.is_default == True, table.c.is_default.is_(None)))
+                connection.execute(table.update().where(others)
+                                   .values(is_default=False, version=table.c.version + 1))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if changes.get('is_default'):
+            cache.delete_prefix('payment_method:')
+        else:
+            cache.delete(PaymentMethod.cache_key(id))
+        if not returning:
+            return None
+        if row is None:
+            return PaymentMethod.find_serialized(id)
+        id, method_type, is_default, version = row
+        return {"id": id, "method_type": METHOD_TYPE_VALUES[method_type], "is_default": is_default,
+                "version": version}
+
+    @staticmethod
+    def find_default():
+        """ Find the default Payment Method, if there is one """
+        return PaymentMethod.query.filter(PaymentMethod.is_default == True).first()
+
     def self_url(self):
-        return url_for('get_payment_method', id=self.id, _external=True)
+        return url_for('payments.get_payment_method', id=self.id, _external=True)
 
     def serialize(self):
-        return {"id": self.id, "method_type": self.method_type.value, "is_default": self.is_default}
+        return {"id": self.id, "method_type": self.method_type.value, "is_default": self.is_default,
+                "version": self.version}
 
     def deserialize(self, data):
         try:
@@ -150,10 +724,357 @@ class PaymentMethod(db.Model):
         return self
 
     def set_default(self):
-        """Sets a payment method to be the default"""
-        self.is_default = True
-        self.save()
+        """Sets a payment method to be the only default, with one UPDATE of every flag"""
+        try:
+            if not self.id:
+                db.session.add(self)
+                db.session.flush()
+            # Only the methods whose flag changes get a new version
+            changes = PaymentMethod.is_default != (PaymentMethod.id == self.id)
+            PaymentMethod.query.filter(db.or_(changes, PaymentMethod.is_default.is_(None))) \
+                .update({PaymentMethod.is_default: PaymentMethod.id == self.id,
+                         PaymentMethod.version: PaymentMethod.version + 1},
+                        synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        # Every method's flag may have changed
+        cache.delete_prefix('payment_method:')
 
 
     def __repr__(self):
         return '<PaymentMethod %d, type %r>' % (self.id, self.method_type)
+
+
+######################################################################
+# Payment summaries
+######################################################################
+# The counts kept for each status
+SUMMARY_COLUMNS = dict((member, member.name.lower()) for member in PaymentStatus)
+# Rows the global totals are spread over, so concurrent writers rarely wait on the same row
+SUMMARY_SLOTS = 16
+
+
+class SummaryCounts(object):
+    """ The count of Payments in each status, kept as they are written """
+    unpaid = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    processing = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    paid = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    @staticmethod
+    def serialize_counts(counts):
+        """ Returns the summary of a dict of status column to count """
+        unpaid, processing, paid = (counts.get(name, 0) for name in ('unpaid', 'processing', 'paid'))
+        return {"unpaid": unpaid, "processing": processing, "paid": paid,
+                "outstanding": unpaid + processing, "total": unpaid + processing + paid}
+
+
+class PaymentSummary(SummaryCounts, db.Model):
+    """ The Payments of one user, counted by status """
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    @staticmethod
+    def find_serialized(user_id):
+        """ Returns the summary of a user's Payments with one primary key read """
+        summary = PaymentSummary.query.get(user_id)
+        counts = dict((name, getattr(summary, name)) for name in SUMMARY_COLUMNS.values()) if summary else {}
+        data = SummaryCounts.serialize_counts(counts)
+        data['user_id'] = user_id
+        return data
+
+    @staticmethod
+    def rebuild():
+        """ Recounts every summary and the totals from the Payments, for an existing database """
+        try:
+            PaymentSummary.query.delete()
+            PaymentTotal.query.delete()
+            counts = db.session.query(Payment.user_id, Payment.status, db.func.count()) \
+                .group_by(Payment.user_id, Payment.status)
+            add_to_summaries(db.session.connection(), counts.all())
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def __repr__(self):
+        return '<PaymentSummary of user %d>' % self.user_id
+
+
+class PaymentTotal(SummaryCounts, db.Model):
+    """ The Payments of every user, counted by status, spread over SUMMARY_SLOTS rows """
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    @staticmethod
+    def find_serialized():
+        """ Returns the summary of all Payments by adding up the slots """
+        columns = [db.func.coalesce(db.func.sum(getattr(PaymentTotal, name)), 0)
+                   for name in ('unpaid', 'processing', 'paid')]
+        unpaid, processing, paid = db.session.query(*columns).one()
+        return SummaryCounts.serialize_counts({'unpaid': int(unpaid), 'processing': int(processing),
+                                               'paid': int(paid)})
+
+    def __repr__(self):
+        return '<PaymentTotal slot %d>' % self.slot
+
+
+def add_to_summaries(connection, changes):
+    """ Adds a list of (user_id, status, count) to the summaries of the users and to the totals """
+    users = {}
+    slots = {}
+    for user_id, status, count in changes:
+        if status is None or not count:
+            continue
+        name = SUMMARY_COLUMNS[status]
+        for deltas, key in ((users, user_id), (slots, user_id % SUMMARY_SLOTS)):
+            counts = deltas.setdefault(key, {})
+            counts[name] = counts.get(name, 0) + count
+    _add_counts(connection, PaymentSummary.__table__, 'user_id', users)
+    _add_counts(connection, PaymentTotal.__table__, 'slot', slots)
+
+def _add_counts(connection, table, key, deltas):
+    """
+    Adds deltas, a dict of key to a dict of column to count, to the rows of a
+    summary table in the current transaction. MySQL does it with one upsert;
+    elsewhere the missing rows are inserted first and then updated.
+    """
+    rows = [dict([('k_' + key, value)] + [('d_' + name, counts.get(name, 0)) for name in SUMMARY_COLUMNS.values()])
+            for value, counts in sorted(deltas.items()) if any(counts.values())]
+    if not rows:
+        return
+    if connection.dialect.name == 'mysql':
+        insert = mysql.insert(table).values(dict([(key, db.bindparam('k_' + key))] +
+                                                 [(name, db.bindparam('d_' + name)) for name in SUMMARY_COLUMNS.values()]))
+        # SQLAlchemy 1.2 only renders a bare insert.inserted column as VALUES(), so it is spelled out
+        update = dict((name, table.c[name] + db.literal_column('VALUES(%s)' % name))
+                      for name in SUMMARY_COLUMNS.values())
+        connection.execute(insert.on_duplicate_key_update(**update), rows)
+        return
+    keys = [row['k_' + key] for row in rows]
+    existing = set()
+    for start in range(0, len(keys), BULK_INSERT_CHUNK):
+        chunk = keys[start:start + BULK_INSERT_CHUNK]
+        existing.update(value for value, in connection.execute(
+            db.select([table.c[key]]).where(table.c[key].in_(chunk))))
+    missing = [value for value in keys if value not in existing]
+    if missing:
+        connection.execute(table.insert(), [dict([(key, value)] + [(name, 0) for name in SUMMARY_COLUMNS.values()])
+                                            for value in missing])
+    update = table.update().where(table.c[key] == db.bindparam('k_' + key)).values(
+        dict((name, table.c[name] + db.bindparam('d_' + name)) for name in SUMMARY_COLUMNS.values()))
+    connection.execute(update, rows)
+
+
+######################################################################
+# Payment events
+######################################################################
+class PaymentEvent(db.Model):
+    """
+    One change of status of a Payment, appended to a log as it happens: its
+    creation (from no status), each transition, and its deletion (to no status).
+    The statuses are kept as their small integer values to keep the rows short.
+    """
+    __table_args__ = (
+        # The history of a Payment, and whether an event is its latest
+        db.Index('ix_payment_event_payment_id_id', 'payment_id', 'id'),
+        # Range scans for the Payments that reached a status before some time
+        db.Index('ix_payment_event_to_status_created_at', 'to_status', 'created_at'),
+    )
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    # Not a foreign key, so the log outlives a deleted Payment
+    payment_id = db.Column(db.Integer, nullable=False)
+    from_status = db.Column(db.SmallInteger)
+    to_status = db.Column(db.SmallInteger)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @staticmethod
+    def log(connection, changes):
+        """ Appends a list of (payment_id, old status, new status) with one statement """
+        now = datetime.utcnow()
+        rows = [{'payment_id': payment_id, 'from_status': old.value if old else None,
+                 'to_status': new.value if new else None, 'created_at': now}
+                for payment_id, old, new in changes if old != new]
+        if rows:
+            connection.execute(PaymentEvent.__table__.insert(), rows)
+
+    @staticmethod
+    def log_moves(connection, query, new_status):
+        """ Appends the move of every Payment of a query to new_status, with one INSERT ... SELECT """
+        old_value = db.case(STATUS_VALUES, value=db.type_coerce(Payment.status, db.String))
+        moves = query.with_entities(Payment.id, old_value, db.literal(new_status.value, db.SmallInteger),
+                                    db.literal(datetime.utcnow(), db.DateTime))
+        connection.execute(PaymentEvent.__table__.insert().from_select(
+            ['payment_id', 'from_status', 'to_status', 'created_at'], moves))
+
+    @staticmethod
+    def history(payment_id):
+        """ Returns the events of a Payment, oldest first """
+        return PaymentEvent.query.filter(PaymentEvent.payment_id == payment_id).order_by(PaymentEvent.id)
+
+    @staticmethod
+    def stuck(status, older_than, limit=100):
+        """
+        Returns (payment_id, since) of the Payments that have been in a status for
+        longer than older_than seconds, longest first. It is a range scan of the
+        events that reached the status before the cutoff, keeping those that no
+        later event of their Payment follows, and never reads the Payment table.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+        later = db.aliased(PaymentEvent)
+        superseded = db.exists().where(db.and_(later.payment_id == PaymentEvent.payment_id,
+                                               later.id > PaymentEvent.id))
+        return db.session.query(PaymentEvent.payment_id, PaymentEvent.created_at) \
+            .filter(PaymentEvent.to_status == status.value, PaymentEvent.created_at < cutoff, ~superseded) \
+            .order_by(PaymentEvent.created_at).limit(limit).all()
+
+    @staticmethod
+    def backfill():
+        """ Logs the creation of every Payment that has no event yet, for an existing database """
+        logged = db.exists().where(PaymentEvent.payment_id == Payment.id)
+        status = db.case(STATUS_VALUES, value=db.type_coerce(Payment.status, db.String))
+        creations = Payment.query.filter(~logged).with_entities(
+            Payment.id, db.null(), status, db.literal(datetime.utcnow(), db.DateTime))
+        try:
+            db.session.connection().execute(PaymentEvent.__table__.insert().from_select(
+                ['payment_id', 'from_status', 'to_status', 'created_at'], creations))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def serialize(self):
+        return {"id": self.id, "payment_id": self.payment_id, "from_status": self.from_status,
+                "to_status": self.to_status, "created_at": self.created_at.isoformat()}
+
+    def __repr__(self):
+        return '<PaymentEvent %d of Payment %d>' % (self.id, self.payment_id)
+
+
+@event.listens_for(Payment, 'after_insert')
+def _count_inserted_payment(mapper, connection, payment):
+    add_to_summaries(connection, [(payment.user_id, payment.status, 1)])
+    PaymentEvent.log(connection, [(payment.id, None, payment.status)])
+
+@event.listens_for(Payment, 'before_update')
+def _check_transition(mapper, connection, payment):
+    # The UPDATE only applies while the row has the version it was read at, so
+    # the status it was read with is still the one the database is moving it from
+    status = attributes.get_history(payment, 'status')
+    if status.deleted and status.added:
+        check_transition(status.deleted[0], status.added[0])
+
+@event.listens_for(Payment, 'after_update')
+def _count_updated_payment(mapper, connection, payment):
+    status = attributes.get_history(payment, 'status')
+    user_id = attributes.get_history(payment, 'user_id')
+    if not status.has_changes() and not user_id.has_changes():
+        return
+    old_status = status.deleted[0] if status.deleted else payment.status
+    old_user_id = user_id.deleted[0] if user_id.deleted else payment.user_id
+    add_to_summaries(connection, [(old_user_id, old_status, -1), (payment.user_id, payment.status, 1)])
+    PaymentEvent.log(connection, [(payment.id, old_status, payment.status)])
+
+@event.listens_for(Payment, 'after_delete')
+def _count_deleted_payment(mapper, connection, payment):
+    add_to_summaries(connection, [(payment.user_id, payment.status, -1)])
+    PaymentEvent.log(connection, [(payment.id, payment.status, None)])
+
+
+class IdempotencyKey(db.Model):
+    """
+    The response given to a request made with an Idempotency-Key header
+
+    It is inserted in the same transaction as the row the request creates, so
+    of two concurrent requests with one key only the first commits, and the
+    other replays its response. Keys expire after IDEMPOTENCY_KEY_TTL seconds.
+    """
+    # Expired keys are deleted once every this many stored keys
+    EVICT_EVERY = 100
+    _stored = itertools.count(1)
+
+    key = db.Column(db.String(128), primary_key=True)
+    fingerprint = db.Column(db.String(40), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    location = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    @staticmethod
+    def ttl():
+        return timedelta(seconds=int(os.getenv('IDEMPOTENCY_KEY_TTL', '86400')))
+
+    @staticmethod
+    def find(key):
+        """ Find the stored response for a key, deleting it if it has expired """
+        record = IdempotencyKey.query.get(key)
+        if record and record.created_at < datetime.utcnow() - IdempotencyKey.ttl():
+            db.session.delete(record)
+            db.session.commit()
+            return None
+        return record
+
+    @staticmethod
+    def save(key, fingerprint, status_code, body, location=None):
+        """ Stores the response for a key and commits it with the rest of the transaction """
+        db.session.add(IdempotencyKey(key=key, fingerprint=fingerprint, status_code=status_code,
+                                      body=body, location=location))
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if next(IdempotencyKey._stored) % IdempotencyKey.EVICT_EVERY == 0:
+            IdempotencyKey.evict()
+
+    @staticmethod
+    def evict():
+        """ Deletes every expired key, through the index on created_at """
+        cutoff = datetime.utcnow() - IdempotencyKey.ttl()
+        IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+
+    def __repr__(self):
+        return '<IdempotencyKey %r>' % self.key
+
+
+class ImportCheckpoint(db.Model):
+    """
+    How far an import of a file has got. It is committed with each chunk of
+    Payments, so an interrupted import resumes right after the last chunk
+    that was stored, without losing or repeating a row.
+    """
+    name = db.Column(db.String(255), primary_key=True)
+    line = db.Column(db.Integer, nullable=False, default=0)
+    inserted = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @staticmethod
+    def find(name):
+        """ Find the checkpoint of an import, if it has stored a chunk """
+        return ImportCheckpoint.query.get(name)
+
+    @staticmethod
+    def save(name, line, inserted, rejected):
+        """ Records the progress of an import and commits it with the rest of the transaction """
+        checkpoint = ImportCheckpoint.query.get(name) or ImportCheckpoint(name=name)
+        checkpoint.line = line
+        checkpoint.inserted = inserted
+        checkpoint.rejected = rejected
+        db.session.add(checkpoint)
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return checkpoint
+
+    @staticmethod
+    def remove(name):
+        """ Forgets the progress of an import, so it starts from the top again """
+        ImportCheckpoint.query.filter(ImportCheckpoint.name == name).delete(synchronize_session=False)
+        db.session.commit()
+
+    def __repr__(self):
+        return '<ImportCheckpoint %r at line %d>' % (self.name, self.line)
@@ -0,0 +1,163 @@
+"""
+Query Profiler
+
+A debugging mode that captures every SQL statement a request runs, with its
+parameters and duration, and the EXPLAIN plan of each distinct SELECT. At the
+end of the request it flags statements that ran repeatedly with different
+parameters, the usual sign of an N+1 loop, and statements slower than a
+threshold. The report is logged as one JSON line (at WARNING when something
+was flagged), and a summary is returned in the X-Query-Profile header.
+
+The plans are taken on a separate connection after the request, so profiling
+adds a round trip per distinct SELECT; keep it off in production.
+
+Settings come from the environment:
+    QUERY_PROFILE           True to turn the profiler on (default False)
+    QUERY_PROFILE_SLOW_MS   statements slower than this are flagged (default 100)
+    QUERY_PROFILE_REPEAT    statements run this many times are flagged (default 5)
+"""
+import os
+import json
+import time
+import logging
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from database import db
+
+# Longest repr of the parameters kept for one statement
+MAX_PARAMETERS_LENGTH = 200
+
+EXPLAIN_PREFIXES = {
+    'mysql': 'EXPLAIN ',
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+logger = logging.getLogger(__name__)
+
+
+def enabled():
+    """ Returns True when QUERY_PROFILE turns the profiler on """
+    return os.getenv('QUERY_PROFILE', 'False') == 'True'
+
+def slow_seconds():
+    return float(os.getenv('QUERY_PROFILE_SLOW_MS', '100')) / 1000
+
+def repeat_threshold():
+    return int(os.getenv('QUERY_PROFILE_REPEAT', '5'))
+
+
+def summarize(statements, slow=0.1, repeat=5):
+    """ Returns the report of a list of (statement, parameters, seconds) """
+    counts = {}
+    for statement, _, _ in statements:
+        counts[statement] = counts.get(statement, 0) + 1
+    return {
+        'queries': len(statements),
+        'ms': round(sum(seconds for _, _, seconds in statements) * 1000, 3),
+        'statements': [{'statement': statement,
+                        'parameters': _format_parameters(parameters),
+                        'ms': round(seconds * 1000, 3),
+                        'slow': seconds >= slow}
+                       for statement, parameters, seconds in statements],
+        'repeated': sorted([{'statement': statement, 'count': count}
+                            for statement, count in counts.items() if count >= repeat],
+                           key=lambda item: -item['count']),
+        'slow': len([seconds for _, _, seconds in statements if seconds >= slow]),
+    }
+
+def header_value(report):
+    """ Returns the summary of a report sent in the X-Query-Profile header """
+    return 'queries=%d; ms=%.3f; slow=%d; repeated=%d' % (
+        report['queries'], report['ms'], report['slow'], len(report['repeated']))
+
+def explain(statements):
+    """ Returns the EXPLAIN rows of each distinct SELECT, keyed by statement """
+    prefix = EXPLAIN_PREFIXES.get(db.engine.dialect.name)
+    if prefix is None:
+        return {}
+    plans = {}
+    g.query_profile_paused = True
+    try:
+        with db.engine.connect() as connection:
+            for statement, parameters, _ in statements:
+                if statement in plans or not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+                try:
+                    rows = connection.execute(prefix + statement, parameters or ())
+                    plans[statement] = [[str(value) for value in row] for row in rows]
+                except Exception as e:
+                    plans[statement] = 'EXPLAIN failed: %s' % e
+    finally:
+        g.query_profile_paused = False
+    return plans
+
+def _format_parameters(parameters):
+    text = repr(parameters)
+    if len(text) > MAX_PARAMETERS_LENGTH:
+        text = text[:MAX_PARAMETERS_LENGTH] + '...'
+    return text
+
+
+######################################################################
+# SQLAlchemy events
+######################################################################
+def _profiling():
+    return has_request_context() and getattr(g, 'query_profile', None) is not None \
+        and not getattr(g, 'query_profile_paused', False)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('profile_start', []).append(time.time())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.time() - conn.info['profile_start'].pop()
+    if _profiling():
+        g.query_profile.append((statement, parameters if not executemany else None, seconds))
+
+def _handle_error(exception_context):
+    starts = exception_context.connection.info.get('profile_start') if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+
+######################################################################
+# Request hooks
+######################################################################
+def _before_request():
+    g.query_profile = []
+
+def _after_request(response):
+    if getattr(g, 'query_profile', None) is not None:
+        report = summarize(g.query_profile, slow_seconds(), repeat_threshold())
+        response.headers['X-Query-Profile'] = header_value(report)
+        g.query_profile_status = response.status_code
+    return response
+
+def _teardown_request(exception):
+    statements = getattr(g, 'query_profile', None)
+    if statements is None:
+        return
+    g.query_profile = None
+    report = summarize(statements, slow_seconds(), repeat_threshold())
+    try:
+        report['explain'] = explain(statements)
+    except Exception as e:
+        report['explain'] = 'EXPLAIN failed: %s' % e
+    report.update(method=request.method, path=request.full_path.rstrip('?'),
+                  status=500 if exception else getattr(g, 'query_profile_status', 500))
+    level = logging.WARNING if report['slow'] or report['repeated'] else logging.INFO
+    logger.log(level, json.dumps(report, default=str, sort_keys=True))
+
+
+def init_app(app):
+    """ Profiles the SQL statements of each request of app when QUERY_PROFILE is on """
+    if not enabled():
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
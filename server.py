@@ -1,30 +1,57 @@
 import os
+import time
 import logging
-from flask import Flask, Response, jsonify, request, json, make_response, url_for
+import hashlib
+import zlib
+from flask import Flask, Blueprint, Response, current_app, jsonify, request, json, make_response, url_for, stream_with_context, abort
 from flask_api import status
-from flask_sqlalchemy import SQLAlchemy
 from flasgger import Swagger
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 from enum import Enum
+from functools import wraps
 from vcap_services import get_database_uri
+import metrics
+import instrumentation
+import profiler
+import migrations
+import importer
+import group_commit
+from models import *
+from models import _is_id
+
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = None
 
 
 ######################################################################
 # Init
 ######################################################################
-app = Flask(__name__)
 DEBUG = (os.getenv('DEBUG', 'False') == 'True')
 PORT = os.getenv('PORT', '5000')
 
-app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
-db.create_all()
+# Largest page a client can ask for with ?limit=
+MAX_PAGE_SIZE = 1000
+# Rows fetched from the server-side cursor (and items encoded) per streamed chunk
+STREAM_CHUNK_SIZE = 1000
+# Most payments accepted by one POST /payments/batch
+MAX_BATCH_SIZE = 10000
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson')
+# Related resources ?expand= can embed in a Payment
+EXPANSIONS = ('method',)
+# Columns of GET /payments/export?format=csv, in order
+EXPORT_COLUMNS = ('id', 'user_id', 'order_id', 'status', 'method_id', 'version')
+# zlib level of a gzipped export; low levels keep up with the cursor at a small cost in size
+EXPORT_GZIP_LEVEL = 1
+# Seconds in a status after which GET /payments/stuck reports a payment, unless ?older_than= says otherwise
+STUCK_AFTER = 600
 
 ######################################################################
 # Configure Swagger before initilaizing it
 ######################################################################
-app.config['SWAGGER'] = {
+SWAGGER_CONFIG = {
     "swagger_version": "2.0",
     "specs": [
         {
@@ -37,49 +64,279 @@ app.config['SWAGGER'] = {
     ]
 }
 
-######################################################################
-# Configure Swagger before initilaizing it
-######################################################################
-Swagger(app)
-
-######################################################################
-# Custom Exceptions
-######################################################################
-class DataValidationError(ValueError):
-    pass
-
-# This needs to be after db, classes, etc are initialized to avoid circular imports
-from models import *
+api = Blueprint('payments', __name__)
 
 ######################################################################
 # Routes
 ######################################################################
 
-@app.route("/")
+@api.route("/")
 def home():
-    return app.send_static_file('index.html')
+    return current_app.send_static_file('index.html')
+
+@api.route("/metrics")
+def get_metrics():
+    """ Returns the service metrics in the Prometheus text exposition format """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 ######################################################################
 # Error Handlers
 ######################################################################
-@app.errorhandler(DataValidationError)
+@api.app_errorhandler(DataValidationError)
 def request_validation_error(e):
     #print "error: %s" % e.message
+    # Drop whatever the rejected body already changed on a loaded model
+    db.session.rollback()
     return make_response(jsonify(status=400, error='Bad Request', message=e.message), status.HTTP_400_BAD_REQUEST)
 
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(e):
     return make_response(jsonify(status=404, error='Not Found', message=e.description), status.HTTP_404_NOT_FOUND)
 
+@api.app_errorhandler(412)
+def precondition_failed(e):
+    return make_response(jsonify(status=412, error='Precondition Failed', message=e.description), status.HTTP_412_PRECONDITION_FAILED)
+
+@api.app_errorhandler(409)
+def conflict(e):
+    return make_response(jsonify(status=409, error='Conflict', message=e.description), status.HTTP_409_CONFLICT)
+
+@api.app_errorhandler(PaymentTransitionError)
+def payment_transition_error(e):
+    # The move was refused, so nothing of this request is kept
+    db.session.rollback()
+    return make_response(jsonify(status=409, error='Conflict', message=e.message), status.HTTP_409_CONFLICT)
+
+@api.app_errorhandler(StaleDataError)
+def stale_data_error(e):
+    # The compare-and-swap UPDATE matched no row, so nothing of this request is kept
+    db.session.rollback()
+    message = 'The resource was changed by another request, fetch it and try again'
+    return make_response(jsonify(status=409, error='Conflict', message=message), status.HTTP_409_CONFLICT)
+
+######################################################################
+# Helpers
+######################################################################
+def get_int_arg(name):
+    """ Returns an integer query parameter, or None if it was not given """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise DataValidationError('Invalid %s: must be an integer' % name)
+
+def parse_status(value, name='status'):
+    """ Returns the PaymentStatus given by its value or name """
+    try:
+        if isinstance(value, bool):
+            # True would otherwise be read as 1, which is UNPAID
+            raise ValueError(value)
+        if isinstance(value, int) or value.isdigit():
+            return PaymentStatus(int(value))
+        return PaymentStatus[value.upper()]
+    except (AttributeError, KeyError, ValueError):
+        raise DataValidationError('Invalid %s: %s is not a payment status' % (name, value))
+
+def get_status_arg(name):
+    """ Returns a PaymentStatus query parameter given by value or name, or None """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    return parse_status(value, name)
+
+def get_expand_arg():
+    """ Returns True when ?expand=method asks for each Payment's method to be embedded """
+    expand = [name for name in request.args.get('expand', '').split(',') if name]
+    for name in expand:
+        if name not in EXPANSIONS:
+            raise DataValidationError('Invalid expand: %s, must be one of %s' % (name, ', '.join(EXPANSIONS)))
+    return 'method' in expand
+
+def get_json_items():
+    """ Returns the items of a JSON array or NDJSON request body, or a parse error per bad line """
+    if request.mimetype in NDJSON_MIMETYPES:
+        items = []
+        for number, line in enumerate(request.get_data().splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(DataValidationError('Invalid JSON on line %d: %s' % (number, e)))
+        return items
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise DataValidationError('Invalid batch: body of request must be a JSON array')
+    return items
+
+def list_etag(versions, extra=''):
+    """ Returns a strong ETag for a listing from the (id, version, ...) of each item in it """
+    digest = hashlib.sha1(extra)
+    for version in versions:
+        digest.update(':'.join(str(value) for value in version) + ';')
+    return digest.hexdigest()
+
+def not_modified(etag, weak=False):
+    """ Returns an empty 304 response when the request's If-None-Match has etag, else None """
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', status.HTTP_304_NOT_MODIFIED)
+        response.set_etag(etag, weak)
+        return response
+    return None
+
+def check_if_match(etag):
+    """ Aborts with 412 when the request has an If-Match header that etag does not satisfy """
+    if request.if_match and not request.if_match.contains(etag):
+        abort(status.HTTP_412_PRECONDITION_FAILED, 'The resource has changed since it was read')
+
+def get_body_version(data):
+    """ Returns the version a request body says it was read at, or None """
+    if not isinstance(data, dict) or data.get('version') is None:
+        return None
+    if not isinstance(data['version'], int) or isinstance(data['version'], bool):
+        raise DataValidationError('Invalid version: must be an integer')
+    return data['version']
+
+def check_version(data, version):
+    """ Aborts with 409 when the body carries the version it was read at and that is not version """
+    expected = get_body_version(data)
+    if expected is not None and expected != version:
+        abort(status.HTTP_409_CONFLICT, 'The resource is at version %d, not %d; fetch it and try again'
+              % (version, expected))
+
+def get_if_match_version(id):
+    """ Returns the version named by the If-Match ETag of a resource, or None without one """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    for etag in request.if_match.as_set():
+        prefix, _, version = etag.rpartition('-')
+        if prefix == str(id) and version.isdigit():
+            return int(version)
+    abort(status.HTTP_412_PRECONDITION_FAILED, 'The resource has changed since it was read')
+
+def prefers_minimal():
+    """ Returns True when the client asked for no body back with Prefer: return=minimal """
+    return 'return=minimal' in request.headers.get('Prefer', '').replace(' ', '').split(',')
+
+def patch_response(model, id):
+    """ Applies a sparse update of a Payment or Payment Method without reading it first """
+    data = request.get_json()
+    changes = model.changes(data)
+    version = get_body_version(data)
+    if_match = get_if_match_version(id)
+    if if_match is not None and version is not None and if_match != version:
+        abort(status.HTTP_412_PRECONDITION_FAILED, 'The resource has changed since it was read')
+    if version is None:
+        version = if_match
+    try:
+        message = model.patch(id, changes, version, returning=not prefers_minimal())
+    except StaleDataError:
+        if if_match is not None:
+            abort(status.HTTP_412_PRECONDITION_FAILED, 'The resource has changed since it was read')
+        raise
+    if message is None:
+        response = make_response('', status.HTTP_204_NO_CONTENT)
+        if version is not None:
+            response.set_etag(model.etag({'id': id, 'version': version + 1}))
+        return response
+    response = make_response(jsonify(message), status.HTTP_200_OK)
+    response.set_etag(model.etag(message))
+    return response
+
+def dumps(data):
+    """ Encodes data as compact JSON, with ujson when it is installed """
+    if fast_json:
+        return fast_json.dumps(data)
+    return json.dumps(data, separators=(',', ':'))
+
+def encode_json(data):
+    """ Encodes data with dumps, counting the time as serialization of the request """
+    start = time.time()
+    try:
+        return dumps(data)
+    finally:
+        instrumentation.record_serialization(time.time() - start)
+
+def json_response(data, code=status.HTTP_200_OK, headers=None):
+    """ Returns a response of data encoded by encode_json """
+    return Response(encode_json(data), status=code, headers=headers, mimetype='application/json')
+
+def replay_response(record, fingerprint):
+    """ Returns the stored response of an idempotent request, if it is replayed with the same body """
+    if record.fingerprint != fingerprint:
+        raise DataValidationError('Invalid request: the Idempotency-Key was already used with a different body')
+    headers = {'Idempotent-Replayed': 'true'}
+    if record.location:
+        headers['Location'] = record.location
+    return Response(record.body, status=record.status_code, headers=headers, mimetype='application/json')
+
+def stream_json_array(items):
+    """ Encodes an iterable of dicts as a JSON array, one chunk of items at a time """
+    yield '['
+    separator = ''
+    chunk = []
+    encoding = 0.0
+    for item in items:
+        start = time.time()
+        chunk.append(dumps(item))
+        encoding += time.time() - start
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+    if chunk:
+        yield separator + ','.join(chunk)
+    yield ']'
+    instrumentation.record_serialization(encoding)
+
+def stream_lines(items, encode, header=None):
+    """ Encodes an iterable of dicts one line each with encode, a chunk of lines at a time """
+    if header:
+        yield header
+    chunk = []
+    encoding = 0.0
+    for item in items:
+        start = time.time()
+        chunk.append(encode(item))
+        encoding += time.time() - start
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+    instrumentation.record_serialization(encoding)
+
+def ndjson_line(payment):
+    return dumps(payment) + '\n'
+
+def csv_line(payment):
+    # Every exported column is an integer, so no value needs quoting
+    return ','.join(str(payment[column]) for column in EXPORT_COLUMNS) + '\r\n'
+
+def gzip_stream(chunks):
+    """ Compresses a stream of chunks into one gzip member as the chunks are produced """
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
 ######################################################################
 # LIST ALL PAYMENTS
 ######################################################################
-@app.route('/payments', methods=['GET'])
+@api.route('/payments', methods=['GET'])
 def list_payments():
     """
     Retrieves a list of payments.
     This endpoint will return all Payments unless a query parameter is specified.
+    Every query parameter given is applied, so filters can be combined.
+    Without a limit the whole list is streamed back as one chunked JSON array.
+    With a limit one page is returned, and the Link and X-Next-Cursor headers
+    point at the next page when there is one.
     ---
     tags:
       - Payments
@@ -97,7 +354,7 @@ def list_payments():
         type: string
       - name: status
         in: query
-        description: Describes if the payment is UNPAID, PROCESSING, or PAID
+        description: Describes if the payment is UNPAID, PROCESSING, or PAID (by name or value)
         required: false
         type: string
       - name: method_id
@@ -105,9 +362,38 @@ def list_payments():
         description: The method id of the payment in the system
         required: false
         type: string
+      - name: limit
+        in: query
+        description: The most payments to return in one page
+        required: false
+        type: integer
+      - name: after
+        in: query
+        description: Only return payments with an id greater than this cursor
+        required: false
+        type: integer
+      - name: expand
+        in: query
+        description: Set to method to embed each payment's payment method, read with the same query
+        required: false
+        type: string
+      - name: If-None-Match
+        in: header
+        description: >
+          ETag of the listing the client holds. Without a limit, the listing only
+          carries a weak ETag in answer to a request that sends If-None-Match
+        required: false
+        type: string
     responses:
       200:
         description: A list of payments
+        headers:
+          Link:
+            type: string
+            description: URL of the next page, with rel="next"
+          X-Next-Cursor:
+            type: integer
+            description: The after value to use for the next page
         schema:
           type: array
           items:
@@ -129,22 +415,303 @@ def list_payments():
                 method_id:
                   type: integer
                   description: The method id of the payment in the system
+                version:
+                  type: integer
+                  description: Goes up by one each time the payment changes
+                method:
+                  type: object
+                  description: The payment method, with expand=method
+      304:
+        description: The listing still matches the If-None-Match ETag
+    """
+    query = Payment.find_by_filters(user_id=get_int_arg('user_id'),
+                                    order_id=get_int_arg('order_id'),
+                                    status=get_status_arg('status'),
+                                    method_id=get_int_arg('method_id'))
+    limit = get_int_arg('limit')
+    with_method = get_expand_arg()
+    if with_method:
+        query = Payment.join_method(query)
+    query = Payment.keyset(query, get_int_arg('after'))
+
+    if limit is None:
+        # The headers go out before the streamed body, so the ETag needs its own pass over
+        # the ids and versions. Only a conditional request pays for it, and the ETag is weak
+        # since it is not computed from the bytes that are sent.
+        etag = None
+        if request.if_none_match:
+            etag = list_etag(Payment.versions(query, with_method))
+            response = not_modified(etag, weak=True)
+            if response:
+                return response
+        response = Response(stream_with_context(stream_json_array(Payment.rows(query, with_method))),
+                            status=status.HTTP_200_OK, mimetype='application/json')
+        if etag:
+            response.set_etag(etag, weak=True)
+        return response
+
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise DataValidationError('Invalid limit: must be between 1 and %d' % MAX_PAGE_SIZE)
+    # Fetch one extra row to find out whether there is a next page
+    results = list(Payment.rows(query.limit(limit + 1), with_method))
+    headers = {}
+    if len(results) > limit:
+        results = results[:limit]
+        cursor = results[-1]['id']
+        args = request.args.to_dict()
+        args['after'] = cursor
+        headers['Link'] = '<%s>; rel="next"' % url_for('payments.list_payments', _external=True, **args)
+        headers['X-Next-Cursor'] = str(cursor)
+    etag = list_etag([Payment.etag_key(payment) for payment in results], headers.get('X-Next-Cursor', ''))
+    response = not_modified(etag)
+    if response:
+        return response
+    response = json_response(results, status.HTTP_200_OK, headers)
+    response.set_etag(etag)
+    return response
+
+######################################################################
+# EXPORT PAYMENTS
+######################################################################
+@api.route('/payments/export', methods=['GET'])
+def export_payments():
+    """
+    Exports payments as NDJSON or CSV
+    This endpoint streams every payment matching the filters, one per line,
+    straight from a server-side cursor, so memory use does not grow with the
+    table. The rows come from a single SELECT and so form a consistent
+    snapshot. The body is gzipped on the fly when the client accepts gzip.
+    ---
+    tags:
+      - Payments
+    produces:
+      - application/x-ndjson
+      - text/csv
+    parameters:
+      - name: format
+        in: query
+        description: ndjson (the default) or csv
+        required: false
+        type: string
+      - name: user_id
+        in: query
+        description: the user id of the payment in the system
+        required: false
+        type: string
+      - name: order_id
+        in: query
+        description: The order id of the payment in the system
+        required: false
+        type: string
+      - name: status
+        in: query
+        description: Describes if the payment is UNPAID, PROCESSING, or PAID (by name or value)
+        required: false
+        type: string
+      - name: method_id
+        in: query
+        description: The method id of the payment in the system
+        required: false
+        type: string
+      - name: Accept-Encoding
+        in: header
+        description: gzip to have the export compressed
+        required: false
+        type: string
+    responses:
+      200:
+        description: One payment per line, with a header line in CSV
+      400:
+        description: Bad Request (e.g. an unknown format)
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        raise DataValidationError('Invalid format: %s, must be ndjson or csv' % export_format)
+    query = Payment.find_by_filters(user_id=get_int_arg('user_id'),
+                                    order_id=get_int_arg('order_id'),
+                                    status=get_status_arg('status'),
+                                    method_id=get_int_arg('method_id'))
+    rows = Payment.rows(Payment.keyset(query))
+    if export_format == 'csv':
+        body = stream_lines(rows, csv_line, ','.join(EXPORT_COLUMNS) + '\r\n')
+        mimetype = 'text/csv'
+    else:
+        body = stream_lines(rows, ndjson_line)
+        mimetype = 'application/x-ndjson'
+    headers = {'Content-Disposition': 'attachment; filename=payments.%s' % export_format,
+               'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(body), status=status.HTTP_200_OK, headers=headers, mimetype=mimetype)
+
+######################################################################
+# SUMMARIZE PAYMENTS
+######################################################################
+@api.route('/payments/summary', methods=['GET'])
+def summarize_payments():
+    """
+    Summarizes payments by status
+    This endpoint returns how many payments a user has in each status, and how
+    many are outstanding (UNPAID or PROCESSING). Without a user_id it covers
+    every payment. The counts are kept up to date as payments are written, so
+    this reads a summary row instead of counting the payments.
+    ---
+    tags:
+      - Payments
+    produces:
+      - application/json
+    parameters:
+      - name: user_id
+        in: query
+        description: the user id of the payments to summarize
+        required: false
+        type: string
+    responses:
+      200:
+        description: The payment counts
+        schema:
+          properties:
+            user_id:
+              type: integer
+              description: The user the counts are for (only with a user_id)
+            unpaid:
+              type: integer
+            processing:
+              type: integer
+            paid:
+              type: integer
+            outstanding:
+              type: integer
+              description: The UNPAID and PROCESSING payments
+            total:
+              type: integer
+      400:
+        description: Bad Request (e.g. a user_id that is not an integer)
     """
-    user_id = request.args.get('user_id')
-    order_id = request.args.get('order_id')
-    if user_id:
-        payments = Payment.find_by_user(user_id)
-    elif order_id:
-        payments = Payment.find_by_order(order_id)
+    user_id = get_int_arg('user_id')
+    if user_id is None:
+        summary = PaymentTotal.find_serialized()
     else:
-        payments = Payment.all()
-    results = [payment.serialize() for payment in payments]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+        summary = PaymentSummary.find_serialized(user_id)
+    return make_response(jsonify(summary), status.HTTP_200_OK)
+
+######################################################################
+# LIST PAYMENTS STUCK IN A STATUS
+######################################################################
+@api.route('/payments/stuck', methods=['GET'])
+def list_stuck_payments():
+    """
+    Lists the payments stuck in a status
+    This endpoint returns the payments that have been in a status (PROCESSING
+    unless another is given) for longer than older_than seconds, longest first.
+    It is answered from the log of status changes with an index range scan,
+    without reading the payments themselves.
+    ---
+    tags:
+      - Payments
+    produces:
+      - application/json
+    parameters:
+      - name: status
+        in: query
+        description: The status the payments are stuck in, by name or value (default PROCESSING)
+        required: false
+        type: string
+      - name: older_than
+        in: query
+        description: How many seconds the payments have been in the status for, at least (default 600)
+        required: false
+        type: integer
+      - name: limit
+        in: query
+        description: The most payments to return (default and most 1000)
+        required: false
+        type: integer
+    responses:
+      200:
+        description: The stuck payments
+        schema:
+          type: array
+          items:
+            properties:
+              id:
+                type: integer
+                description: The id of the payment
+              status:
+                type: integer
+              since:
+                type: string
+                description: When the payment moved to the status, in UTC
+      400:
+        description: Bad Request (e.g. an unknown status)
+    """
+    stuck_status = get_status_arg('status') or PaymentStatus.PROCESSING
+    older_than = get_int_arg('older_than')
+    limit = get_int_arg('limit')
+    if older_than is None:
+        older_than = STUCK_AFTER
+    if limit is None:
+        limit = MAX_PAGE_SIZE
+    if older_than < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise DataValidationError('Invalid query: older_than may not be negative, and limit must be from 1 to %d'
+                                  % MAX_PAGE_SIZE)
+    stuck = [{'id': payment_id, 'status': stuck_status.value, 'since': since.isoformat()}
+             for payment_id, since in PaymentEvent.stuck(stuck_status, older_than, limit)]
+    return make_response(jsonify(stuck), status.HTTP_200_OK)
+
+######################################################################
+# LIST THE STATUS CHANGES OF A PAYMENT
+######################################################################
+@api.route('/payments/<int:id>/events', methods=['GET'])
+def list_payment_events(id):
+    """
+    Lists the status changes of a Payment
+    This endpoint returns the log of a payment's creation, status changes and
+    deletion, oldest first. It is still there after the payment is deleted.
+    ---
+    tags:
+      - Payments
+    produces:
+      - application/json
+    parameters:
+      - name: id
+        in: path
+        description: ID of the payment
+        type: integer
+        required: true
+    responses:
+      200:
+        description: The events of the payment
+        schema:
+          type: array
+          items:
+            properties:
+              id:
+                type: integer
+              payment_id:
+                type: integer
+              from_status:
+                type: integer
+                description: The status before the change, null when the payment was created
+              to_status:
+                type: integer
+                description: The status after the change, null when the payment was deleted
+              created_at:
+                type: string
+                description: When the change was made, in UTC
+      404:
+        description: The payment has no events
+    """
+    events = [event.serialize() for event in PaymentEvent.history(id)]
+    if not events:
+        abort(status.HTTP_404_NOT_FOUND, 'Payment %d has no events' % id)
+    return make_response(jsonify(events), status.HTTP_200_OK)
 
 ######################################################################
 # RETRIEVE A PAYMENT
 ######################################################################
-@app.route('/payments/<int:id>', methods=['GET'])
+@api.route('/payments/<int:id>', methods=['GET'])
 def get_payment(id):
     """
     Retrieves a single Payment
@@ -160,6 +727,16 @@ def get_payment(id):
         description: ID of payment to retrive
         type: integer
         required: true
+      - name: expand
+        in: query
+        description: Set to method to embed the payment method of the payment
+        type: string
+        required: false
+      - name: If-None-Match
+        in: header
+        description: ETag of the copy the client holds
+        type: string
+        required: false
     responses:
         200:
             description: Payment returned with that id
@@ -181,16 +758,30 @@ def get_payment(id):
                     method_id:
                         type: integer
                         description: The method id of the payment in the system
+                    version:
+                        type: integer
+                        description: Goes up by one each time the payment changes
+                    method:
+                        type: object
+                        description: The payment method, with expand=method
+        304:
+            description: The payment still matches the If-None-Match ETag
         404:
             description: Payment not found
     """
-    payment = Payment.find_or_404(id)
-    return make_response(jsonify(payment.serialize()), status.HTTP_200_OK)
+    data = Payment.find_serialized(id, get_expand_arg())
+    etag = Payment.etag(data)
+    response = not_modified(etag)
+    if response:
+        return response
+    response = make_response(jsonify(data), status.HTTP_200_OK)
+    response.set_etag(etag)
+    return response
 
 ######################################################################
 # UPDATE AN EXISTING PAYMENT
 ######################################################################
-@app.route('/payments/<int:id>', methods=['PUT'])
+@api.route('/payments/<int:id>', methods=['PUT'])
 def update_payment(id):
     """
     Update a Payment
@@ -228,7 +819,16 @@ def update_payment(id):
           description: ID of payment to retrieve
           type: integer
           required: true
-
+        - name: version
+          in: body
+          description: The version the payment was read at; the update only applies while it still has it
+          type: integer
+          required: false
+        - name: If-Match
+          in: header
+          description: Only update the payment while it still has this ETag
+          type: string
+          required: false
 
     responses:
         200:
@@ -253,22 +853,103 @@ def update_payment(id):
                         description: The method id of the payment in the system
         400:
             description: Bad Request
+        409:
+            description: The payment has another version than the one given, or was changed by another request while this one ran
+        412:
+            description: The payment no longer matches the If-Match ETag
     """
 
+    data = request.get_json()
     payment = Payment.find_or_404(id)
-    payment.deserialize(request.get_json())
+    check_if_match(Payment.etag(payment.serialize()))
+    check_version(data, payment.version)
+    payment.deserialize(data)
     payment.id = id
+    payment.check_method()
     payment.save()
-    return make_response(jsonify(payment.serialize()), status.HTTP_200_OK)
+    message = payment.serialize()
+    response = make_response(jsonify(message), status.HTTP_200_OK)
+    response.set_etag(Payment.etag(message))
+    return response
+
+######################################################################
+# UPDATE SOME FIELDS OF A PAYMENT
+######################################################################
+@api.route('/payments/<int:id>', methods=['PATCH'])
+def patch_payment(id):
+    """
+    Update some fields of a Payment
+    This endpoint will change only the fields present in the body, with one
+    UPDATE of those columns and no read of the payment first. Changing status
+    or user_id also reads the old values, for the payment summaries.
+    ---
+    tags:
+        - Payments
+    consumes:
+        - application/json
+    produces:
+        - application/json
+    parameters:
+        - name: id
+          in: path
+          description: ID of payment to update
+          type: integer
+          required: true
+        - in: body
+          name: body
+          required: true
+          schema:
+            properties:
+                user_id:
+                    type: integer
+                order_id:
+                    type: integer
+                status:
+                    type: integer
+                    description: The value of UNPAID, PROCESSING or PAID
+                method_id:
+                    type: integer
+                version:
+                    type: integer
+                    description: The version the payment was read at; the update only applies while it still has it
+        - name: If-Match
+          in: header
+          description: Only update the payment while it still has this ETag
+          type: string
+          required: false
+        - name: Prefer
+          in: header
+          description: return=minimal to get an empty 204 instead of reading the payment back
+          type: string
+          required: false
+    responses:
+        200:
+            description: Payment updated
+            schema:
+                id: Payment
+        204:
+            description: Payment updated, with no body as return=minimal asked
+        400:
+            description: Bad Request (e.g. an unknown field, or none to change)
+        404:
+            description: Payment not found
+        409:
+            description: The payment has another version than the one given
+        412:
+            description: The payment no longer matches the If-Match ETag
+    """
+    return patch_response(Payment, id)
 
 ######################################################################
 # ADD A NEW PAYMENT
 ######################################################################
-@app.route('/payments', methods=['POST'])
+@api.route('/payments', methods=['POST'])
 def create_payment():
     """
     Create a payment
     This endpoint will create a payment based on the data in the body that is posted.
+    A retry sent with the same Idempotency-Key header gets the first response back
+    instead of creating the payment again.
     ---
     tags:
         - Payments
@@ -277,6 +958,11 @@ def create_payment():
     produces:
         - application/json
     parameters:
+        - name: Idempotency-Key
+          in: header
+          description: A unique key chosen by the client, to make retries safe
+          type: string
+          required: false
         - in: body
           user_id: body
           required: true
@@ -321,17 +1007,210 @@ def create_payment():
                     description: Bad Request
         """
 
+    key = request.headers.get('Idempotency-Key')
+    if key:
+        if len(key) > 128:
+            raise DataValidationError('Invalid Idempotency-Key: at most 128 characters are allowed')
+        fingerprint = hashlib.sha1(request.get_data()).hexdigest()
+        stored = IdempotencyKey.find(key)
+        if stored:
+            return replay_response(stored, fingerprint)
+
     payment = Payment()
     print request.get_json()
     payment.deserialize(request.get_json())
-    payment.save()
+    payment.check_method()
+    if group_commit.enabled() and not key:
+        # Committed along with the payments of concurrent requests
+        group_commit.committer.insert(payment)
+    else:
+        # With a key the payment is committed together with the stored response
+        payment.save(commit=not key)
     message = payment.serialize()
-    return make_response(jsonify(message), status.HTTP_201_CREATED, {'Location': payment.self_url() })
+    if key:
+        try:
+            IdempotencyKey.save(key, fingerprint, status.HTTP_201_CREATED, encode_json(message), payment.self_url())
+        except IntegrityError:
+            # A concurrent request with the same key committed first, so answer as it did.
+            # Without a stored key the commit failed for another reason, so let it surface.
+            stored = IdempotencyKey.find(key)
+            if stored is None:
+                raise
+            return replay_response(stored, fingerprint)
+    response = make_response(jsonify(message), status.HTTP_201_CREATED, {'Location': payment.self_url() })
+    response.set_etag(Payment.etag(message))
+    return response
+
+######################################################################
+# ADD A BATCH OF PAYMENTS
+######################################################################
+@api.route('/payments/batch', methods=['POST'])
+def create_payments():
+    """
+    Create a batch of payments
+    This endpoint will create every valid payment in a JSON array (or NDJSON)
+    body in one transaction, and report an error for each invalid one.
+    ---
+    tags:
+        - Payments
+    consumes:
+        - application/json
+        - application/x-ndjson
+    produces:
+        - application/json
+    parameters:
+        - in: body
+          name: body
+          required: true
+          schema:
+            type: array
+            items:
+              schema:
+                id: data
+    responses:
+        201:
+            description: Payments created
+            schema:
+                properties:
+                    ids:
+                        type: array
+                        description: The ids of the created payments, in the order posted
+                        items:
+                            type: integer
+                    errors:
+                        type: array
+                        description: The position and reason of each payment that was rejected
+                        items:
+                            properties:
+                                index:
+                                    type: integer
+                                message:
+                                    type: string
+        400:
+            description: Bad Request, or no payment in the batch was valid
+    """
+    items = get_json_items()
+    if len(items) > MAX_BATCH_SIZE:
+        raise DataValidationError('Invalid batch: at most %d payments are allowed' % MAX_BATCH_SIZE)
+
+    payments = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            if isinstance(item, DataValidationError):
+                raise item
+            payment = Payment().deserialize(item)
+            payment.id = None    # ids are always assigned by the database
+            payments.append((index, payment))
+        except DataValidationError as e:
+            errors.append({'index': index, 'message': e.message})
+
+    # One check of every method_id in the batch, instead of a lookup per payment
+    without_method = set(Payment.without_method([payment for _, payment in payments]))
+    for index, payment in payments:
+        if payment in without_method:
+            errors.append({'index': index, 'message': 'Invalid payment: payment method %s does not exist' % payment.method_id})
+    errors.sort(key=lambda error: error['index'])
+    payments = [payment for _, payment in payments if payment not in without_method]
+
+    ids = Payment.bulk_insert(payments) if payments else []
+    code = status.HTTP_201_CREATED if ids else status.HTTP_400_BAD_REQUEST
+    return make_response(jsonify(ids=ids, errors=errors), code)
+
+######################################################################
+# MOVE A SET OF PAYMENTS TO A NEW STATUS
+######################################################################
+@api.route('/payments/status', methods=['PATCH'])
+def update_payments_status():
+    """
+    Move a set of payments to a new status
+    This endpoint will move the payments listed by id, or matching a filter,
+    to a new status in one statement. Payments that may not make the move
+    (e.g. PAID back to PROCESSING) are skipped.
+    ---
+    tags:
+        - Payments
+    consumes:
+        - application/json
+    produces:
+        - application/json
+    parameters:
+        - in: body
+          name: body
+          required: true
+          schema:
+            required:
+                - status
+            properties:
+                status:
+                    type: string
+                    description: The status to move to, by name or value
+                ids:
+                    type: array
+                    description: The ids of the payments to move
+                    items:
+                        type: integer
+                filter:
+                    type: object
+                    description: Moves every payment matching these user_id, order_id, status and method_id values instead
+    responses:
+        200:
+            description: Payments moved
+            schema:
+                properties:
+                    updated:
+                        type: integer
+                        description: How many payments were moved
+                    ids:
+                        type: array
+                        description: The ids of the payments that were moved (when ids were given)
+                        items:
+                            type: integer
+                    skipped:
+                        type: array
+                        description: Each payment that was not moved, and the reason (when ids were given)
+                        items:
+                            properties:
+                                id:
+                                    type: integer
+                                reason:
+                                    type: string
+        400:
+            description: Bad Request
+    """
+    data = request.get_json()
+    if not isinstance(data, dict) or 'status' not in data:
+        raise DataValidationError('Invalid status change: missing status')
+    new_status = parse_status(data['status'])
+
+    if 'filter' in data:
+        filters = data['filter']
+        if not isinstance(filters, dict) or not set(filters) <= set(['user_id', 'order_id', 'status', 'method_id']):
+            raise DataValidationError('Invalid status change: filter may only use user_id, order_id, status and method_id')
+        if not filters:
+            # An empty filter would match, and move, every payment
+            raise DataValidationError('Invalid status change: filter must use at least one field')
+        for name in ('user_id', 'order_id', 'method_id'):
+            if name in filters and not _is_id(filters[name]):
+                raise DataValidationError('Invalid status change: filter %s must be an integer' % name)
+        if 'status' in filters:
+            filters['status'] = parse_status(filters['status'], 'filter status')
+        count = Payment.transition_where(Payment.find_by_filters(**filters), new_status)
+        return make_response(jsonify(updated=count), status.HTTP_200_OK)
+
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not all(_is_id(i) for i in ids):
+        raise DataValidationError('Invalid status change: ids must be a list of payment ids')
+    if len(ids) > MAX_BATCH_SIZE:
+        raise DataValidationError('Invalid status change: at most %d ids are allowed' % MAX_BATCH_SIZE)
+    updated, skipped = Payment.transition(sorted(set(ids)), new_status)
+    skipped = [{'id': i, 'reason': reason} for i, reason in sorted(skipped.items())]
+    return make_response(jsonify(updated=len(updated), ids=updated, skipped=skipped), status.HTTP_200_OK)
 
 ######################################################################
 # DELETE A PAYMENT
 ######################################################################
-@app.route('/payments/<int:id>', methods=['DELETE'])
+@api.route('/payments/<int:id>', methods=['DELETE'])
 def delete_payment(id):
     """
     Delete a Payment
@@ -359,7 +1238,7 @@ def delete_payment(id):
 ######################################################################
 # DELETE ALL PAYMENT DATA (for testing only)
 ######################################################################
-@app.route('/payments/reset', methods=['DELETE'])
+@api.route('/payments/reset', methods=['DELETE'])
 def payments_reset():
     """ Removes all payments from the database """
     Payment.remove_all()
@@ -368,7 +1247,7 @@ def payments_reset():
 ######################################################################
 # LIST ALL PAYMENT METHODS
 ######################################################################
-@app.route('/payments/methods', methods=['GET'])
+@api.route('/payments/methods', methods=['GET'])
 def list_payment_methods():
     """
     Retrieve a list of payment methods.
@@ -401,14 +1280,14 @@ def list_payment_methods():
                                 description: Signals that this is the default payment method
     """
 
-    payment_methods = PaymentMethod.all()
-    results = [ pm.serialize() for pm in payment_methods]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    results = PaymentMethod.rows(PaymentMethod.query)
+    return Response(stream_with_context(stream_json_array(results)),
+                    status=status.HTTP_200_OK, mimetype='application/json')
 
 ######################################################################
 # RETRIEVE A PAYMENT METHOD
 ######################################################################
-@app.route('/payments/methods/<int:id>', methods=['GET'])
+@api.route('/payments/methods/<int:id>', methods=['GET'])
 def get_payment_method(id):
     """
     Retrieve a single payment method
@@ -424,6 +1303,11 @@ def get_payment_method(id):
           description: ID of payment method to retrieve
           type: integer
           required: true
+        - name: If-None-Match
+          in: header
+          description: ETag of the copy the client holds
+          type: string
+          required: false
     responses:
         200:
             description: Payment method returned
@@ -443,17 +1327,51 @@ def get_payment_method(id):
                     is_default:
                         type: boolean
                         description: Signals that this is the default payment method
+        304:
+            description: The payment method still matches the If-None-Match ETag
         404:
             description: Payment method not found
     """
 
-    pm = PaymentMethod.find_or_404(id)
+    data = PaymentMethod.find_serialized(id)
+    etag = PaymentMethod.etag(data)
+    response = not_modified(etag)
+    if response:
+        return response
+    response = make_response(jsonify(data), status.HTTP_200_OK)
+    response.set_etag(etag)
+    return response
+
+######################################################################
+# RETRIEVE THE DEFAULT PAYMENT METHOD
+######################################################################
+@api.route('/payments/methods/default', methods=['GET'])
+def get_default_payment_method():
+    """
+    Retrieve the default payment method
+    This endpoint will return the payment method that is set as the default
+    ---
+    tags:
+        - Payment Methods
+    produces:
+        - application/json
+    responses:
+        200:
+            description: Default payment method returned
+            schema:
+                id: PaymentMethod
+        404:
+            description: No payment method is set as the default
+    """
+    pm = PaymentMethod.find_default()
+    if not pm:
+        abort(status.HTTP_404_NOT_FOUND, 'No payment method is set as the default')
     return make_response(jsonify(pm.serialize()), status.HTTP_200_OK)
 
 ######################################################################
 # UPDATE AN EXISTING PAYMENT METHOD
 ######################################################################
-@app.route('/payments/methods/<int:id>', methods=['PUT'])
+@api.route('/payments/methods/<int:id>', methods=['PUT'])
 def update_payment_method(id):
     """
     Update a payment method
@@ -481,6 +1399,16 @@ def update_payment_method(id):
           description: specifies whether payment method is default
           type: string
           required: true
+        - name: version
+          in: body
+          description: The version the payment method was read at; the update only applies while it still has it
+          type: integer
+          required: false
+        - name: If-Match
+          in: header
+          description: Only update the payment method while it still has this ETag
+          type: string
+          required: false
 
     responses:
         200:
@@ -501,20 +1429,96 @@ def update_payment_method(id):
                     is_default:
                         type: boolean
                         description: Signals that this is the default payment method
+                    version:
+                        type: integer
+                        description: Goes up by one with every change of the payment method
         400:
             description: Bad Request
+        409:
+            description: The payment method has another version than the one given, or was changed by another request while this one ran
+        412:
+            description: The payment method no longer matches the If-Match ETag
     """
-    print(request.get_json())
+    data = request.get_json()
     pm = PaymentMethod.find_or_404(id)
-    pm.deserialize(request.get_json())
+    check_if_match(PaymentMethod.etag(pm.serialize()))
+    check_version(data, pm.version)
+    pm.deserialize(data)
     pm.id = id
     pm.save()
-    return make_response(jsonify(pm.serialize()), status.HTTP_200_OK)
+    message = pm.serialize()
+    response = make_response(jsonify(message), status.HTTP_200_OK)
+    response.set_etag(PaymentMethod.etag(message))
+    return response
+
+######################################################################
+# UPDATE SOME FIELDS OF A PAYMENT METHOD
+######################################################################
+@api.route('/payments/methods/<int:id>', methods=['PATCH'])
+def patch_payment_method(id):
+    """
+    Update some fields of a payment method
+    This endpoint will change only the fields present in the body, with one
+    UPDATE of those columns and no read of the payment method first.
+    ---
+    tags:
+        - Payment Methods
+    consumes:
+        - application/json
+    produces:
+        - application/json
+    parameters:
+        - name: id
+          in: path
+          description: id of payment method to update
+          type: integer
+          required: true
+        - in: body
+          name: body
+          required: true
+          schema:
+            properties:
+                method_type:
+                    type: integer
+                    description: The value of CREDIT, DEBIT or PAYPAL
+                is_default:
+                    type: boolean
+                    description: true makes it the only default, clearing the flag of every other payment method
+                version:
+                    type: integer
+                    description: The version the payment method was read at; the update only applies while it still has it
+        - name: If-Match
+          in: header
+          description: Only update the payment method while it still has this ETag
+          type: string
+          required: false
+        - name: Prefer
+          in: header
+          description: return=minimal to get an empty 204 instead of reading the payment method back
+          type: string
+          required: false
+    responses:
+        200:
+            description: Payment method updated
+            schema:
+                id: PaymentMethod
+        204:
+            description: Payment method updated, with no body as return=minimal asked
+        400:
+            description: Bad Request (e.g. an unknown field, or none to change)
+        404:
+            description: Payment method not found
+        409:
+            description: The payment method has another version than the one given
+        412:
+            description: The payment method no longer matches the If-Match ETag
+    """
+    return patch_response(PaymentMethod, id)
 
 ######################################################################
 # ADD A NEW PAYMENT METHOD
 ######################################################################
-@app.route('/payments/methods', methods=['POST'])
+@api.route('/payments/methods', methods=['POST'])
 def create_payment_method():
     """
     Make a new payment method.
@@ -582,7 +1586,7 @@ def create_payment_method():
 ######################################################################
 # DELETE A PAYMENT METHOD
 ######################################################################
-@app.route('/payments/methods/<int:id>', methods=['DELETE'])
+@api.route('/payments/methods/<int:id>', methods=['DELETE'])
 def delete_payment_method(id):
     """
     Delete a payment method
@@ -600,17 +1604,24 @@ def delete_payment_method(id):
     responses:
         204:
             description: Payment Method deleted
+        409:
+            description: Payments still use the Payment Method
     """
 
     pm = PaymentMethod.find(id)
     if pm:
-        pm.delete()
+        try:
+            pm.delete()
+        except IntegrityError:
+            db.session.rollback()
+            message = 'The payment method is used by payments and cannot be deleted'
+            return make_response(jsonify(status=409, error='Conflict', message=message), status.HTTP_409_CONFLICT)
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 ######################################################################
 # SET PAYMENT METHOD AS DEFAULT
 ######################################################################
-@app.route('/payments/methods/<int:id>/set-default', methods=['PUT'])
+@api.route('/payments/methods/<int:id>/set-default', methods=['PUT'])
 def set_payment_method_default(id):
     """
     Set a default payment method.
@@ -648,12 +1659,52 @@ def set_payment_method_default(id):
     """
     pm = PaymentMethod.find_or_404(id)
     pm.set_default()
-    return make_response(jsonify(pm.serialize(), status.HTTP_200_OK))
+    return make_response(jsonify(pm.serialize()), status.HTTP_200_OK)
+
+######################################################################
+# Application Factory
+######################################################################
+def cache_document(view):
+    """ Builds a Swagger document on its first request and serves that copy after """
+    documents = {}
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.path not in documents:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            documents[request.path] = (response.get_data(), response.mimetype)
+        data, mimetype = documents[request.path]
+        return Response(data, mimetype=mimetype)
+    return wrapper
+
+
+def init_db():
+    """ Creates the tables and adds any missing columns and indexes """
+    migrations.upgrade()
+
+
+def create_app():
+    """ Returns the app, with nothing touching the database until a request does """
+    app = Flask(__name__)
+    instrumentation.init_app(app)
+    profiler.init_app(app)
+    app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SWAGGER'] = SWAGGER_CONFIG
+    db.init_app(app)
+    Swagger(app, decorators=[cache_document])
+    app.register_blueprint(api)
+    app.cli.command('init-db')(init_db)
+    app.cli.add_command(importer.import_command)
+    return app
+
+app = create_app()
 
 ######################################################################
 # Main
 ######################################################################
 
 if __name__ == "__main__":
-    db.create_all()
     app.run(host='0.0.0.0', port=int(PORT), debug=DEBUG)
@@ -0,0 +1,99 @@
+import unittest
+import os
+import time
+from mock import patch
+import gunicorn_config
+from cache import NullCache, LRUCache, RedisCache, IdSet, KEY_PREFIX, make_cache
+
+class FakeRedis(object):
+    """ Stands in for a Redis client, keeping values in a dict """
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def setex(self, key, ttl, value):
+        self.values[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def scan_iter(self, match, count=None):
+        return [key for key in list(self.values) if key.startswith(match.rstrip('*'))]
+
+class TestCache(unittest.TestCase):
+
+    def test_lru_cache(self):
+        """Keep the most recently used entries"""
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('payment:1', {'id': 1})
+        cache.set('payment:2', {'id': 2})
+        self.assertEqual(cache.get('payment:1'), {'id': 1})
+        cache.set('payment:3', {'id': 3})
+        self.assertEqual(cache.get('payment:2'), None)
+        self.assertEqual(cache.get('payment:1'), {'id': 1})
+        self.assertEqual(cache.get('payment:3'), {'id': 3})
+
+    def test_lru_cache_expiry(self):
+        """Drop entries once they are older than the TTL"""
+        cache = LRUCache(ttl=-1)
+        cache.set('payment:1', {'id': 1})
+        self.assertEqual(cache.get('payment:1'), None)
+
+    def test_lru_cache_invalidation(self):
+        """Delete entries by key and by prefix"""
+        cache = LRUCache()
+        cache.set('payment:1', {'id': 1})
+        cache.set('payment:2', {'id': 2})
+        cache.set('payment_method:1', {'id': 1})
+        cache.delete('payment:1')
+        self.assertEqual(cache.get('payment:1'), None)
+        cache.delete_prefix('payment:')
+        self.assertEqual(cache.get('payment:2'), None)
+        self.assertEqual(cache.get('payment_method:1'), {'id': 1})
+
+    def test_redis_cache(self):
+        """Keep namespaced JSON entries in a Redis-protocol store"""
+        client = FakeRedis()
+        client.values['other'] = 'kept'
+        cache = RedisCache(client, ttl=60)
+        cache.set('payment:1', {'id': 1})
+        cache.set('payment_method:1', {'id': 1})
+        self.assertTrue(KEY_PREFIX + 'payment:1' in client.values)
+        self.assertEqual(cache.get('payment:1'), {'id': 1})
+        cache.delete_prefix('payment:')
+        self.assertEqual(cache.get('payment:1'), None)
+        self.assertEqual(cache.get('payment_method:1'), {'id': 1})
+        cache.clear()
+        self.assertEqual(cache.get('payment_method:1'), None)
+        self.assertEqual(client.values, {'other': 'kept'})
+
+    def test_id_set(self):
+        """Report the ids not known to exist, forgetting them after the TTL"""
+        ids = IdSet(ttl=60)
+        ids.add(1, 2)
+        self.assertEqual(ids.missing([1, 2, 3]), set([3]))
+        ids.discard(2)
+        self.assertEqual(ids.missing([1, 2]), set([2]))
+        ids._expires = time.time() - 1
+        self.assertEqual(ids.missing([1]), set([1]))
+        disabled = IdSet(ttl=0)
+        disabled.add(1)
+        self.assertEqual(disabled.missing([1]), set([1]))
+
+    def test_no_in_process_cache_with_several_workers(self):
+        """Turn the per-worker cache off when several gunicorn workers have no shared one"""
+        with patch.dict(os.environ, {'WEB_CONCURRENCY': '4'}):
+            os.environ.pop('CACHE_URL', None)
+            os.environ.pop('CACHE_TTL', None)
+            os.environ.pop('METHOD_IDS_TTL', None)
+            reload(gunicorn_config)
+            self.assertTrue(isinstance(make_cache(), NullCache))
+            self.assertFalse('METHOD_IDS_TTL' in os.environ)
+        with patch.dict(os.environ, {'WEB_CONCURRENCY': '1'}):
+            os.environ.pop('CACHE_TTL', None)
+            reload(gunicorn_config)
+            self.assertTrue(isinstance(make_cache(), LRUCache))
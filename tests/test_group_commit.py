@@ -0,0 +1,95 @@
+import unittest
+import json
+import threading
+import logging
+from flask_api import status
+from mock import patch
+from server import Payment, PaymentStatus, PaymentMethod, PaymentMethodType, PaymentSummary, app, db
+from vcap_services import get_database_uri
+from cache import cache, method_ids
+from group_commit import GroupCommitter
+import group_commit
+
+def new_payment(order_id, method_id=1):
+    return Payment(user_id=1, order_id=order_id, status=PaymentStatus.UNPAID, method_id=method_id)
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        app.debug = True
+        app.logger.addHandler(logging.StreamHandler())
+        app.logger.setLevel(logging.CRITICAL)
+        app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        cache.clear()
+        method_ids.clear()
+        PaymentMethod(method_type=PaymentMethodType.CREDIT, is_default=True).save()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def insert_concurrently(self, committer, payments):
+        """ Inserts each Payment from its own thread, returning the errors by order_id """
+        errors = {}
+        def insert(payment):
+            with app.app_context():
+                try:
+                    committer.insert(payment)
+                except Exception as e:
+                    errors[payment.order_id] = e
+                finally:
+                    db.session.remove()
+        threads = [threading.Thread(target=insert, args=(payment,)) for payment in payments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_insert_a_batch(self):
+        """Commit the payments of concurrent requests together once the batch is full"""
+        committer = GroupCommitter(window=5, max_rows=4)
+        payments = [new_payment(n) for n in range(4)]
+        with patch.object(committer, 'write', wraps=committer.write) as write:
+            self.assertEqual(self.insert_concurrently(committer, payments), {})
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(sorted(p.id for p in payments), [1, 2, 3, 4])
+        self.assertEqual(sorted(p.order_id for p in Payment.all()), [0, 1, 2, 3])
+        self.assertEqual(PaymentSummary.find_serialized(1)['unpaid'], 4)
+
+    def test_insert_after_the_window(self):
+        """Commit a batch that is not full once its window is over"""
+        committer = GroupCommitter(window=0.001, max_rows=100)
+        payment = new_payment(7)
+        committer.insert(payment)
+        self.assertEqual(Payment.find(payment.id).order_id, 7)
+        self.assertEqual(payment.serialize()['version'], 1)
+
+    def test_failed_payment_only_fails_itself(self):
+        """Retry a failed batch one payment at a time"""
+        committer = GroupCommitter(window=5, max_rows=3)
+        payments = [new_payment(0), new_payment(1, method_id=None), new_payment(2)]
+        errors = self.insert_concurrently(committer, payments)
+        self.assertEqual(list(errors), [1])
+        self.assertEqual(sorted(p.order_id for p in Payment.all()), [0, 2])
+
+    @patch('group_commit.enabled', return_value=True)
+    def test_post_a_payment_with_group_commit(self, enabled):
+        """Create a payment through group commit, but not one with an Idempotency-Key"""
+        client = app.test_client()
+        js = {'user_id': 1, 'order_id': 1, 'status': PaymentStatus.UNPAID.value, 'method_id': 1}
+        with patch.object(group_commit.committer, 'insert', wraps=group_commit.committer.insert) as insert:
+            resp = client.post('/payments', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(json.loads(resp.data)['id'], 1)
+            self.assertEqual(resp.headers['ETag'], '"1-1"')
+            resp = client.post('/payments', data=json.dumps(js), content_type='application/json',
+                               headers={'Idempotency-Key': 'abc'})
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(insert.call_count, 1)
+        self.assertEqual(Payment.find_by_order(1).count(), 2)
@@ -0,0 +1,93 @@
+import unittest
+import json
+import gzip
+import os
+import shutil
+import tempfile
+import logging
+from server import Payment, PaymentMethod, PaymentMethodType, ImportCheckpoint, app, db
+from vcap_services import get_database_uri
+from cache import cache, method_ids
+from importer import import_payments, guess_format, read_records
+
+def payment_row(user_id, method_id=1, status=1):
+    return {'user_id': user_id, 'order_id': user_id, 'status': status, 'method_id': method_id}
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        app.debug = True
+        app.logger.addHandler(logging.StreamHandler())
+        app.logger.setLevel(logging.CRITICAL)
+        app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        cache.clear()
+        method_ids.clear()
+        PaymentMethod(method_type=PaymentMethodType.CREDIT, is_default=True).save()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        shutil.rmtree(self.dir)
+
+    def write_ndjson(self, name, lines, opener=open):
+        path = os.path.join(self.dir, name)
+        with opener(path, 'wb') as f:
+            for line in lines:
+                f.write((line if isinstance(line, str) else json.dumps(line)) + '\n')
+        return path
+
+    def read_rejects(self, path):
+        with open(path + '.rejects.ndjson') as f:
+            return [json.loads(line) for line in f]
+
+    def test_guess_format(self):
+        """Tell the format from the file extension"""
+        self.assertEqual(guess_format('payments.csv'), 'csv')
+        self.assertEqual(guess_format('payments.csv.gz'), 'csv')
+        self.assertEqual(guess_format('payments.ndjson.gz'), 'ndjson')
+        self.assertEqual(guess_format('payments.json'), 'ndjson')
+
+    def test_import_ndjson(self):
+        """Import the valid rows of an NDJSON file and reject the rest with their line"""
+        path = self.write_ndjson('payments.ndjson', [
+            payment_row(1), payment_row(2), '{not json', payment_row(3, method_id=99),
+            {'user_id': 4}, '', payment_row(5, status=3)])
+        totals = import_payments(path, chunk_size=2)
+        self.assertEqual(totals, {'inserted': 3, 'rejected': 3})
+        self.assertEqual(sorted(payment.user_id for payment in Payment.all()), [1, 2, 5])
+        rejects = self.read_rejects(path)
+        self.assertEqual([reject['line'] for reject in rejects], [3, 4, 5])
+        self.assertIn('does not exist', rejects[1]['message'])
+        self.assertEqual(rejects[1]['record']['user_id'], 3)
+        self.assertEqual(rejects[0]['record'], '{not json')
+        checkpoint = ImportCheckpoint.find(os.path.abspath(path))
+        self.assertEqual((checkpoint.line, checkpoint.inserted, checkpoint.rejected), (7, 3, 3))
+
+    def test_import_csv_gzip(self):
+        """Import a gzipped CSV file, with the header on line 1"""
+        path = os.path.join(self.dir, 'payments.csv.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write('user_id,order_id,status,method_id\r\n1,1,1,1\r\n2,2,1,7\r\n3,3,2,1\r\n')
+        self.assertEqual(import_payments(path), {'inserted': 2, 'rejected': 1})
+        self.assertEqual(self.read_rejects(path)[0]['line'], 3)
+        self.assertEqual(sorted(payment.user_id for payment in Payment.all()), [1, 3])
+
+    def test_resume_import(self):
+        """Resume after the checkpoint, and start over with restart"""
+        path = self.write_ndjson('payments.ndjson', [payment_row(i) for i in range(1, 6)])
+        ImportCheckpoint.save(os.path.abspath(path), 3, 3, 0)
+        self.assertEqual(import_payments(path, chunk_size=2), {'inserted': 5, 'rejected': 0})
+        self.assertEqual(sorted(payment.user_id for payment in Payment.all()), [4, 5])
+        self.assertEqual(import_payments(path, restart=True), {'inserted': 5, 'rejected': 0})
+        self.assertEqual(len(Payment.all()), 7)
+
+    def test_read_records(self):
+        """Read CSV fields as ints or None where they are empty"""
+        rows = list(read_records(['user_id,status,method_id', '1,3,'], 'csv'))
+        self.assertEqual(rows, [(2, {'user_id': 1, 'status': 3, 'method_id': None}, None)])
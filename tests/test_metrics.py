@@ -0,0 +1,64 @@
+import unittest
+import os
+from flask import Flask
+import metrics
+from database import PaymentsSQLAlchemy, TimedQueuePool
+from vcap_services import get_pool_options
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registered = list(metrics.REGISTRY)
+
+    def tearDown(self):
+        metrics.REGISTRY[:] = self.registered
+
+    def test_counter(self):
+        """Count events by label"""
+        counter = metrics.Counter('test_events_total', 'Events')
+        counter.inc(route='a')
+        counter.inc(2, route='a')
+        counter.inc(route='b')
+        text = counter.render()
+        self.assertTrue('# TYPE test_events_total counter' in text)
+        self.assertTrue('test_events_total{route="a"} 3.0' in text)
+        self.assertTrue('test_events_total{route="b"} 1.0' in text)
+
+    def test_histogram(self):
+        """Count observations into cumulative buckets"""
+        histogram = metrics.Histogram('test_seconds', 'Durations', buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        text = histogram.render()
+        self.assertTrue('test_seconds_bucket{le="0.1"} 1.0' in text)
+        self.assertTrue('test_seconds_bucket{le="1.0"} 2.0' in text)
+        self.assertTrue('test_seconds_bucket{le="+Inf"} 3.0' in text)
+        self.assertTrue('test_seconds_count 3.0' in text)
+        self.assertTrue('test_seconds_sum 5.55' in text)
+
+    def test_gauge(self):
+        """Read a gauge from its function, leaving it out while it has no value"""
+        value = [None]
+        gauge = metrics.Gauge('test_level', 'Level', lambda: value[0])
+        self.assertFalse('\ntest_level ' in metrics.render())
+        value[0] = 0.5
+        self.assertTrue('\ntest_level 0.5' in metrics.render())
+
+    def test_pool_options_from_environment(self):
+        """Size the MySQL connection pool from the environment"""
+        os.environ['DB_POOL_SIZE'] = '3'
+        os.environ['DB_POOL_PRE_PING'] = 'False'
+        try:
+            options = get_pool_options()
+            self.assertEqual(options['pool_size'], 3)
+            self.assertFalse(options['pool_pre_ping'])
+            app = Flask(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://root@localhost:3306/payments'
+            app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            engine = PaymentsSQLAlchemy(app).get_engine(app)
+            self.assertTrue(isinstance(engine.pool, TimedQueuePool))
+            self.assertEqual(engine.pool.size(), 3)
+        finally:
+            del os.environ['DB_POOL_SIZE']
+            del os.environ['DB_POOL_PRE_PING']
@@ -0,0 +1,97 @@
+import unittest
+import logging
+from sqlalchemy import inspect
+from mock import patch, Mock
+from server import Payment, PaymentMethod, PaymentMethodType, PaymentSummary, PaymentTotal, PaymentEvent, app, db
+from vcap_services import get_database_uri
+import migrations
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        # Only log criticl errors
+        app.debug = True
+        app.logger.addHandler(logging.StreamHandler())
+        app.logger.setLevel(logging.CRITICAL)
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_upgrade_adds_missing_indexes(self):
+        """Upgrade recreates an index that is missing from an existing table"""
+        index = [ix for ix in Payment.__table__.indexes if ix.name == 'ix_payment_user_id_status'][0]
+        index.drop(bind=db.engine)
+        names = [ix['name'] for ix in inspect(db.engine).get_indexes('payment')]
+        self.assertFalse('ix_payment_user_id_status' in names)
+        migrations.upgrade()
+        names = [ix['name'] for ix in inspect(db.engine).get_indexes('payment')]
+        self.assertTrue('ix_payment_user_id_status' in names)
+
+    def test_upgrade_adds_missing_columns(self):
+        """Upgrade adds a column that is missing from an existing table"""
+        db.drop_all()
+        db.engine.execute('CREATE TABLE payment (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL, '
+                          'order_id INTEGER NOT NULL, status VARCHAR(10), method_id INTEGER NOT NULL)')
+        db.engine.execute("INSERT INTO payment (id, user_id, order_id, status, method_id) VALUES (1, 2, 3, 'PAID', 1)")
+        migrations.upgrade()
+        names = [column['name'] for column in inspect(db.engine).get_columns('payment')]
+        self.assertTrue('version' in names)
+        self.assertEqual(Payment.find(1).version, 1)
+
+    def test_upgrade_is_repeatable(self):
+        """Upgrade leaves an up to date database alone"""
+        migrations.upgrade()
+        migrations.upgrade()
+        names = [ix['name'] for ix in inspect(db.engine).get_indexes('payment')]
+        self.assertTrue('ix_payment_status' in names)
+
+    def test_upgrade_counts_payments_into_new_summaries(self):
+        """Upgrade fills the summary tables and the event log it creates from the existing payments"""
+        db.drop_all()
+        db.engine.execute('CREATE TABLE payment (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL, '
+                          'order_id INTEGER NOT NULL, status VARCHAR(10), method_id INTEGER NOT NULL)')
+        db.engine.execute("INSERT INTO payment (id, user_id, order_id, status, method_id) VALUES "
+                          "(1, 2, 3, 'PAID', 1), (2, 2, 4, 'UNPAID', 1), (3, 5, 6, 'UNPAID', 1)")
+        migrations.upgrade()
+        self.assertEqual(PaymentSummary.find_serialized(2)['paid'], 1)
+        self.assertEqual(PaymentSummary.find_serialized(2)['outstanding'], 1)
+        self.assertEqual(PaymentTotal.find_serialized()['total'], 3)
+        self.assertEqual([(e.from_status, e.to_status) for e in PaymentEvent.history(2)], [(None, 1)])
+        migrations.upgrade()
+        self.assertEqual(PaymentTotal.find_serialized()['total'], 3)
+        self.assertEqual(PaymentEvent.query.count(), 3)
+
+    def test_upgrade_skips_a_foreign_key_that_rows_break(self):
+        """Upgrade leaves out a foreign key while rows refer to missing parents, and adds it once they are fixed"""
+        # A payment table from before the foreign key, with a row whose method does not exist
+        db.drop_all()
+        PaymentMethod.__table__.create(bind=db.engine)
+        db.engine.execute('CREATE TABLE payment (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL, '
+                          'order_id INTEGER NOT NULL, status VARCHAR(10), method_id INTEGER NOT NULL)')
+        PaymentMethod(method_type=PaymentMethodType.CREDIT).save()
+        db.engine.execute("INSERT INTO payment (id, user_id, order_id, status, method_id) VALUES "
+                          "(1, 1, 1, 'UNPAID', 1), (2, 1, 2, 'UNPAID', 99)")
+        constraint = [fk for fk in Payment.__table__.foreign_key_constraints
+                      if fk.referred_table.name == 'payment_method'][0]
+        self.assertEqual(migrations.count_orphans(constraint), 1)
+        # Make the database look like a MySQL one without the foreign key
+        inspector = Mock()
+        inspector.get_foreign_keys.return_value = []
+        with patch.object(db.engine.dialect, 'name', 'mysql'), \
+                patch('migrations.inspect', return_value=inspector), \
+                patch('migrations.AddConstraint', return_value='SELECT 1') as add:
+            with patch('migrations.logging.warning') as warning:
+                migrations.add_missing_foreign_keys()
+            self.assertTrue(warning.called)
+            self.assertFalse(any(call[0][0] is constraint for call in add.call_args_list))
+            db.engine.execute(Payment.__table__.delete().where(Payment.__table__.c.method_id == 99))
+            migrations.add_missing_foreign_keys()
+            self.assertTrue(any(call[0][0] is constraint for call in add.call_args_list))
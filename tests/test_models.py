@@ -1,8 +1,15 @@
 import unittest
 import json
 from flask_api import status
-from server import Payment, PaymentStatus, PaymentMethodType, PaymentMethod, app, db, DataValidationError
+from sqlalchemy.orm.exc import StaleDataError
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from server import Payment, PaymentStatus, PaymentMethodType, PaymentMethod, IdempotencyKey, PaymentSummary, PaymentTotal, PaymentEvent, PaymentTransitionError, app, db, DataValidationError
 from vcap_services import get_database_uri
+from cache import cache, method_ids
+from mock import patch, Mock
+import models
+from sqlalchemy import event
 import logging
 import os
 
@@ -15,13 +22,21 @@ class TestModels(unittest.TestCase):
         app.logger.setLevel(logging.CRITICAL)
         # Set up the test database
         app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+        self.context = app.app_context()
+        self.context.push()
         db.drop_all()    # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        cache.clear()    # the tables were recreated behind the cache's back
+        method_ids.clear()
+        # The Payments of the tests refer to Payment Methods 1 to 3, which the foreign key requires
+        for method_type in PaymentMethodType:
+            PaymentMethod(method_type=method_type, is_default=False).save()
         self.app = app.test_client()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        self.context.pop()
 
     def test_construct_a_payment(self):
         """Create a payment and assert that it exists and was properly initialized"""
@@ -38,7 +53,7 @@ class TestModels(unittest.TestCase):
         """Create a payment and add it to the database"""
         # pm = PaymentMethod(method_type=PaymentMethodType.CREDIT)
         payment = Payment(user_id=0, order_id=0, status=PaymentStatus.UNPAID,
-            method_id=0)
+            method_id=1)
         self.assertTrue(payment != None)
         payment.save()
         self.assertEqual(payment.id, 1)
@@ -115,7 +130,7 @@ class TestModels(unittest.TestCase):
     def test_recreate_table(self):
         """A test recreate table"""
         payment = Payment(user_id=0, order_id=0, status=PaymentStatus.UNPAID,
-            method_id=0)
+            method_id=1)
         self.assertTrue(payment != None)
         payment.save()
         self.assertEqual(payment.id, 1)
@@ -125,3 +140,231 @@ class TestModels(unittest.TestCase):
         Payment.remove_all();
         p = Payment.find(1)
         self.assertNotEqual(p, payment)
+
+    def test_keyset_payments(self):
+        """Page through Payments with an id cursor"""
+        for user_id in range(3):
+            Payment(user_id=user_id, order_id=0, status=PaymentStatus.UNPAID,
+                method_id=1).save()
+        payments = Payment.keyset(Payment.query).all()
+        self.assertEqual([p.id for p in payments], [1, 2, 3])
+        payments = Payment.keyset(Payment.find_by_order(0), after=1).all()
+        self.assertEqual([p.id for p in payments], [2, 3])
+
+    def test_find_payment_by_filters(self):
+        """Find Payments matching several filters at once"""
+        Payment(user_id=1, order_id=1, status=PaymentStatus.UNPAID, method_id=1).save()
+        Payment(user_id=1, order_id=2, status=PaymentStatus.PAID, method_id=1).save()
+        Payment(user_id=1, order_id=3, status=PaymentStatus.PAID, method_id=2).save()
+        Payment(user_id=2, order_id=4, status=PaymentStatus.PAID, method_id=1).save()
+        payments = Payment.find_by_filters(user_id=1, status=PaymentStatus.PAID).all()
+        self.assertEqual(sorted(p.order_id for p in payments), [2, 3])
+        payments = Payment.find_by_filters(user_id=1, status=PaymentStatus.PAID, method_id=1).all()
+        self.assertEqual([p.order_id for p in payments], [2])
+        self.assertEqual(Payment.find_by_filters().count(), 4)
+
+    def test_bulk_insert_payments(self):
+        """Insert many Payments at once"""
+        Payment(user_id=0, order_id=0, status=PaymentStatus.UNPAID, method_id=1).save()
+        payments = [Payment(user_id=1, order_id=n, status=PaymentStatus.PAID, method_id=1)
+                    for n in range(2500)]
+        ids = Payment.bulk_insert(payments)
+        self.assertEqual(ids, range(2, 2502))
+        self.assertEqual(payments[-1].id, 2501)
+        self.assertEqual(Payment.find(2501).order_id, 2499)
+        self.assertEqual(Payment.find_by_user(1).count(), 2500)
+
+    def test_bulk_insert_ids_follow_the_increment(self):
+        """Space the ids of a bulk insert by MySQL's auto_increment_increment, as ClearDB sets it"""
+        connection = Mock()
+        connection.dialect.name = 'mysql'
+        connection.connection.info = {}
+        connection.execute.return_value.scalar.return_value = 10
+        self.assertEqual(models._id_increment(connection), 10)
+        self.assertEqual(models._id_increment(connection), 10)
+        self.assertEqual(connection.execute.call_count, 1)
+        result = Mock(lastrowid=101)
+        result.dialect.name = 'mysql'
+        self.assertEqual(models._inserted_ids(result, 3, 10), [101, 111, 121])
+        result.dialect.name = 'sqlite'
+        self.assertEqual(models._inserted_ids(result, 3, 10), [81, 91, 101])
+        self.assertEqual(models._id_increment(db.session.connection()), 1)
+
+    def test_transition_payments(self):
+        """Move Payments to a new status only where the move is legal"""
+        Payment(user_id=1, order_id=1, status=PaymentStatus.UNPAID, method_id=1).save()
+        Payment(user_id=1, order_id=2, status=PaymentStatus.PAID, method_id=1).save()
+        updated, skipped = Payment.transition([1, 2, 3], PaymentStatus.PROCESSING)
+        self.assertEqual(updated, [1])
+        self.assertEqual(sorted(skipped), [2, 3])
+        self.assertEqual(Payment.find(1).status, PaymentStatus.PROCESSING)
+        self.assertEqual(Payment.find(2).status, PaymentStatus.PAID)
+        count = Payment.transition_where(Payment.find_by_user(1), PaymentStatus.PAID)
+        self.assertEqual(count, 1)
+        self.assertEqual(Payment.find(1).status, PaymentStatus.PAID)
+
+    def test_set_default_clears_other_payment_methods(self):
+        """Setting a default payment method clears the flag on every other one"""
+        p1 = PaymentMethod(method_type=PaymentMethodType.CREDIT)
+        p1.save()
+        p2 = PaymentMethod(method_type=PaymentMethodType.DEBIT)
+        p2.save()
+        p1.set_default()
+        self.assertEqual(PaymentMethod.find_default().id, p1.id)
+        p2.set_default()
+        self.assertTrue(p2.is_default)
+        self.assertFalse(PaymentMethod.find(p1.id).is_default)
+        self.assertEqual(PaymentMethod.find_default().id, p2.id)
+
+    def test_save_a_payment_changed_by_someone_else(self):
+        """Refuse to save over a Payment that changed since it was read"""
+        payment = Payment(user_id=1, order_id=1, status=PaymentStatus.UNPAID, method_id=1)
+        payment.save()
+        self.assertEqual(payment.version, 1)
+        # Another connection changes the row behind this session's back
+        db.engine.execute(Payment.__table__.update().values(version=2))
+        payment.status = PaymentStatus.PROCESSING
+        self.assertRaises(StaleDataError, payment.save)
+
+    def test_save_a_payment_method_changed_by_someone_else(self):
+        """Refuse to save over a Payment Method that changed since it was read"""
+        method = PaymentMethod(method_type=PaymentMethodType.CREDIT, is_default=False)
+        method.save()
+        self.assertEqual(method.version, 1)
+        db.engine.execute(PaymentMethod.__table__.update().values(version=2))
+        method.method_type = PaymentMethodType.DEBIT
+        self.assertRaises(StaleDataError, method.save)
+
+    def test_set_default_bumps_the_versions_it_changes(self):
+        """Bump the version of only the Payment Methods whose default flag changes"""
+        methods = [PaymentMethod(method_type=method_type, is_default=False) for method_type in PaymentMethodType]
+        for method in methods:
+            method.save()
+        methods[0].set_default()
+        self.assertEqual([PaymentMethod.find(m.id).version for m in methods], [2, 1, 1])
+        methods[1].set_default()
+        self.assertEqual([PaymentMethod.find(m.id).version for m in methods], [3, 2, 1])
+
+    def test_serialize_payments_from_rows(self):
+        """Serialize Payments from their columns the same way as serialize()"""
+        Payment(user_id=1, order_id=2, status=PaymentStatus.PROCESSING, method_id=3).save()
+        Payment(user_id=4, order_id=5, status=PaymentStatus.PAID, method_id=2).save()
+        expected = [p.serialize() for p in Payment.keyset(Payment.query)]
+        self.assertEqual(list(Payment.rows(Payment.keyset(Payment.query))), expected)
+
+    def test_serialize_payments_with_methods_from_rows(self):
+        """Serialize Payments with the Payment Method of each, read by one JOIN"""
+        method = PaymentMethod(method_type=PaymentMethodType.DEBIT)
+        method.save()
+        payment = Payment(user_id=1, order_id=2, status=PaymentStatus.PAID, method_id=method.id)
+        payment.save()
+        self.assertEqual(payment.method, method)
+        rows = list(Payment.rows(Payment.keyset(Payment.join_method(Payment.query)), with_method=True))
+        expected = payment.serialize()
+        expected['method'] = method.serialize()
+        self.assertEqual(rows, [expected])
+
+    def test_payment_method_ids_are_checked_once(self):
+        """Check method ids with one query, then from the ids known to exist"""
+        method = PaymentMethod(method_type=PaymentMethodType.CREDIT)
+        method.save()
+        method_ids.clear()
+        self.assertEqual(PaymentMethod.missing_ids([method.id, 5, 6]), set([5, 6]))
+        with patch.object(db.session, 'query') as query:
+            self.assertEqual(PaymentMethod.missing_ids([method.id]), set())
+            self.assertFalse(query.called)
+        method.delete()
+        self.assertEqual(PaymentMethod.missing_ids([method.id]), set([method.id]))
+
+    def test_serialize_payment_methods_from_rows(self):
+        """Serialize Payment Methods from their columns the same way as serialize()"""
+        PaymentMethod(method_type=PaymentMethodType.CREDIT).save()
+        PaymentMethod(method_type=PaymentMethodType.PAYPAL, is_default=True).save()
+        expected = [pm.serialize() for pm in PaymentMethod.query.order_by(PaymentMethod.id)]
+        rows = PaymentMethod.rows(PaymentMethod.query.order_by(PaymentMethod.id))
+        self.assertEqual(list(rows), expected)
+
+    def test_idempotency_key_is_stored_with_its_payment(self):
+        """A duplicate Idempotency Key rolls back the Payment created with it"""
+        Payment(user_id=1, order_id=1, status=PaymentStatus.UNPAID, method_id=1).save(commit=False)
+        IdempotencyKey.save('key', 'fingerprint', 201, '{}')
+        Payment(user_id=1, order_id=1, status=PaymentStatus.UNPAID, method_id=1).save(commit=False)
+        self.assertRaises(IntegrityError, IdempotencyKey.save, 'key', 'fingerprint', 201, '{}')
+        self.assertEqual(Payment.find_by_order(1).count(), 1)
+        self.assertEqual(IdempotencyKey.find('key').status_code, 201)
+
+    def test_evict_expired_idempotency_keys(self):
+        """Delete Idempotency Keys older than their TTL"""
+        IdempotencyKey.save('old', 'fingerprint', 201, '{}')
+        IdempotencyKey.save('new', 'fingerprint', 201, '{}')
+        IdempotencyKey.query.filter_by(key='old').update({'created_at': datetime.utcnow() - timedelta(days=2)})
+        db.session.commit()
+        IdempotencyKey.evict()
+        self.assertEqual([k.key for k in IdempotencyKey.query.all()], ['new'])
+
+    def test_payment_summaries_follow_writes(self):
+        """Count Payments into the summaries as they are written, and only when committed"""
+        Payment.bulk_insert([Payment(user_id=1, order_id=n, status=PaymentStatus.UNPAID, method_id=1)
+                             for n in range(3)] +
+                            [Payment(user_id=17, order_id=3, status=PaymentStatus.PAID, method_id=1)])
+        Payment(user_id=1, order_id=4, status=PaymentStatus.PROCESSING, method_id=1).save(commit=False)
+        db.session.rollback()
+        payment = Payment.find(1)
+        payment.status = PaymentStatus.PROCESSING
+        payment.save()
+        self.assertEqual(PaymentSummary.find_serialized(1),
+                         {'user_id': 1, 'unpaid': 2, 'processing': 1, 'paid': 0, 'outstanding': 3, 'total': 3})
+        self.assertEqual(PaymentSummary.find_serialized(2)['total'], 0)
+        # Users 1 and 17 share a slot of the totals
+        self.assertEqual(PaymentTotal.query.count(), 1)
+        self.assertEqual(PaymentTotal.find_serialized()['total'], 4)
+        Payment.find(4).delete()
+        counts = PaymentTotal.find_serialized()
+        PaymentSummary.rebuild()
+        self.assertEqual(PaymentTotal.find_serialized(), counts)
+        self.assertEqual(counts['paid'], 0)
+
+    def test_patch_a_payment_with_one_update(self):
+        """Write the changed columns of a Payment with one UPDATE and no SELECT"""
+        Payment(user_id=1, order_id=1, status=PaymentStatus.UNPAID, method_id=1).save()
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.split(None, 1)[0])
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual(Payment.patch(1, {'order_id': 7}, version=1, returning=False), None)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(statements, ['UPDATE'])
+        self.assertEqual(Payment.find(1).order_id, 7)
+        self.assertEqual(Payment.find(1).version, 2)
+        self.assertRaises(StaleDataError, Payment.patch, 1, {'order_id': 8}, 1)
+
+    def test_payment_moves_are_checked(self):
+        """Refuse a move of status that the transitions do not allow"""
+        payment = Payment(user_id=1, order_id=1, status=PaymentStatus.UNPAID, method_id=1)
+        payment.save()
+        payment.status = PaymentStatus.PAID
+        self.assertRaises(PaymentTransitionError, payment.save)
+        db.session.rollback()
+        self.assertRaises(PaymentTransitionError, Payment.patch, payment.id, {'status': PaymentStatus.PAID})
+        self.assertEqual(Payment.find(payment.id).status, PaymentStatus.UNPAID)
+        self.assertEqual([(e.from_status, e.to_status) for e in PaymentEvent.history(payment.id)],
+                         [(None, PaymentStatus.UNPAID.value)])
+
+    def test_stuck_payments_are_found_from_the_event_log(self):
+        """Find stuck Payments with range scans of the event log, without reading the Payments"""
+        if db.engine.dialect.name != 'sqlite':
+            self.skipTest("reads the plan from SQLite's EXPLAIN QUERY PLAN")
+        plans = []
+        def explain(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT payment_event.payment_id'):
+                plans.extend(row[-1] for row in conn.connection.execute('EXPLAIN QUERY PLAN ' + statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', explain)
+        try:
+            PaymentEvent.stuck(PaymentStatus.PROCESSING, 600)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', explain)
+        self.assertTrue(any('ix_payment_event_to_status_created_at' in plan for plan in plans))
+        self.assertTrue(any('ix_payment_event_payment_id_id' in plan for plan in plans))
+        self.assertFalse(any('payment ' in plan + ' ' for plan in plans))
@@ -0,0 +1,61 @@
+import unittest
+import os
+import logging
+from mock import patch
+import profiler
+import server
+from server import Payment, PaymentStatus, PaymentMethod, PaymentMethodType, db
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        with patch.dict(os.environ, {'QUERY_PROFILE': 'True'}):
+            self.flask_app = server.create_app()
+        self.flask_app.logger.setLevel(logging.CRITICAL)
+        self.context = self.flask_app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        # The Payments of the tests refer to Payment Methods 1 to 3, which the foreign key requires
+        for method_type in PaymentMethodType:
+            PaymentMethod(method_type=method_type, is_default=False).save()
+        self.app = self.flask_app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_summarize_flags_repeated_statements(self):
+        """Flag a statement run once per row as a likely N+1"""
+        select = 'SELECT * FROM payment_method WHERE id = ?'
+        statements = [(select, (n,), 0.001) for n in range(6)] + [('SELECT * FROM payment', (), 0.002)]
+        report = profiler.summarize(statements, slow=0.1, repeat=5)
+        self.assertEqual(report['queries'], 7)
+        self.assertEqual(report['repeated'], [{'statement': select, 'count': 6}])
+        self.assertEqual(report['slow'], 0)
+
+    def test_summarize_flags_slow_statements(self):
+        """Flag a statement slower than the threshold"""
+        report = profiler.summarize([('SELECT * FROM payment', (), 0.5)], slow=0.1, repeat=5)
+        self.assertEqual(report['slow'], 1)
+        self.assertTrue(report['statements'][0]['slow'])
+        self.assertEqual(report['repeated'], [])
+
+    def test_profile_header(self):
+        """Return the query profile of a request in its X-Query-Profile header"""
+        payment = Payment(user_id=1, order_id=2, status=PaymentStatus.UNPAID, method_id=3)
+        payment.save()
+        resp = self.app.get('/payments?user_id=1')
+        self.assertTrue(resp.headers['X-Query-Profile'].startswith('queries='))
+
+    def test_profile_log(self):
+        """Log each request's statements with their EXPLAIN plans"""
+        with patch.object(profiler.logger, 'log') as log:
+            self.app.get('/payments?limit=5')
+        report = profiler.json.loads(log.call_args[0][1])
+        self.assertEqual(report['path'], '/payments?limit=5')
+        self.assertEqual(report['status'], 200)
+        self.assertTrue(report['queries'] >= 1)
+        select = report['statements'][0]['statement']
+        self.assertTrue(isinstance(report['explain'][select], list))
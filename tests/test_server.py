@@ -1,10 +1,18 @@
 import unittest
 import logging
 import json
+import zlib
 from flask_api import status    # HTTP Status Codes
-from server import Payment, PaymentStatus, PaymentMethodType, PaymentMethod, app, db
+import server
+from datetime import datetime, timedelta
+from server import Payment, PaymentStatus, PaymentMethodType, PaymentMethod, PaymentEvent, IdempotencyKey, app, db
 from vcap_services import get_database_uri
+from cache import cache, method_ids
 import os
+from mock import patch
+from flasgger.base import APISpecsView
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 
 class TestServer(unittest.TestCase):
 
@@ -15,23 +23,81 @@ class TestServer(unittest.TestCase):
         app.logger.setLevel(logging.CRITICAL)
         # Set up the test database
         app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
+        self.context = app.app_context()
+        self.context.push()
         db.drop_all()    # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
+        cache.clear()    # the tables were recreated behind the cache's back
+        method_ids.clear()
         self.app = app.test_client()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        self.context.pop()
+
+    def add_payment_methods(self):
+        """ Adds the Payment Methods 1 to 3 that the payments of a test refer to """
+        for method_type in PaymentMethodType:
+            PaymentMethod(method_type=method_type, is_default=False).save()
 
     def test_get_home(self):
         """GET the home page"""
         resp = self.app.get('/')
         self.assertTrue('NYU DevOps Fall 2017 Payments' in resp.data)
 
+    def test_get_spec(self):
+        """GET the Swagger spec, built once and served from memory after"""
+        resp = self.app.get('/v1/spec')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue('/payments' in json.loads(resp.data)['paths'])
+        again = self.app.get('/v1/spec')
+        self.assertEqual(again.status_code, status.HTTP_200_OK)
+        self.assertEqual(again.data, resp.data)
+        # A fresh app has not built its spec yet, so count how often it does
+        build = APISpecsView.get
+        with patch.object(APISpecsView, 'get', autospec=True, side_effect=build) as builder:
+            client = server.create_app().test_client()
+            for _ in range(2):
+                resp = client.get('/v1/spec')
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(builder.call_count, 1)
+
+    def test_create_app_without_database(self):
+        """Create an app whose database cannot be reached, which only fails on use"""
+        uri = 'mysql+pymysql://nobody@127.0.0.1:1/payments'
+        with patch('server.get_database_uri', return_value=uri):
+            other = server.create_app()
+        self.assertEqual(other.config['SQLALCHEMY_DATABASE_URI'], uri)
+        self.assertTrue('init-db' in other.cli.commands)
+
+    def test_get_metrics(self):
+        """GET the metrics in text exposition format"""
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertTrue('# TYPE db_pool_checkout_seconds histogram' in resp.data)
+
+    def test_get_metrics_of_requests(self):
+        """GET the latency, statement count and encoding time of earlier requests"""
+        self.add_payment_methods()
+        payment = Payment(user_id=1, order_id=2, status=PaymentStatus.UNPAID, method_id=3)
+        payment.save()
+        self.app.get('/payments/%d' % payment.id)
+        self.app.get('/payments?limit=10')
+        self.app.get('/no/such/page')
+        data = self.app.get('/metrics').data
+        self.assertTrue('http_request_duration_seconds_count{method="GET",route="/payments/<int:id>",status="200"}' in data)
+        self.assertTrue('http_request_duration_seconds_count{method="GET",route="unmatched",status="404"}' in data)
+        self.assertTrue('http_request_queries_bucket{method="GET",route="/payments/<int:id>",le="1.0"}' in data)
+        self.assertTrue('http_request_serialize_seconds_sum{method="GET",route="/payments"}' in data)
+        self.assertTrue('db_query_duration_seconds_count{operation="SELECT"}' in data)
+
     def test_post_a_payment(self):
         """Create a payment using a POST"""
+        self.add_payment_methods()
         js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
-            'method_id': 0}
+            'method_id': 1}
         resp = self.app.post('/payments', data=json.dumps(js), follow_redirects=True, content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
         get_resp = self.app.get('/payments/1')
@@ -41,6 +107,7 @@ class TestServer(unittest.TestCase):
 
     def test_post_an_invalid_payment(self):
         """POST a payment with invalid information"""
+        self.add_payment_methods()
         js = {'user_id': 0, 'order_id': 0, 'status': 'bad_data',
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments', data=json.dumps(js), follow_redirects=True, content_type='application/json')
@@ -49,13 +116,124 @@ class TestServer(unittest.TestCase):
 
     def test_post_a_payment_with_missing_information(self):
         """POST a payment with missing information"""
+        self.add_payment_methods()
         js = {'order_id': 0, 'status': PaymentStatus.UNPAID.value,
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments', data=json.dumps(js), follow_redirects=True, content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_post_a_payment_with_idempotency_key(self):
+        """Retry a POST with the same Idempotency-Key"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 7, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        headers = {'Idempotency-Key': 'order-7-attempt'}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        first = json.loads(resp.data)
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(resp.data), first)
+        self.assertTrue(resp.headers['Location'].endswith('/payments/%d' % first['id']))
+        self.assertEqual(Payment.find_by_order(7).count(), 1)
+        # The same key with another body is refused
+        js['order_id'] = 8
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Payment.find_by_order(8).count(), 0)
+
+    def test_post_a_payment_with_idempotency_key_that_fails_to_commit(self):
+        """POST with an Idempotency-Key whose commit fails without a stored key to replay"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 7, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        headers = {'Idempotency-Key': 'order-7-attempt'}
+        error = IntegrityError('INSERT', {}, Exception('constraint failed'))
+        with patch.object(IdempotencyKey, 'save', side_effect=error):
+            with self.assertRaises(IntegrityError):
+                self.app.post('/payments', data=json.dumps(js), content_type='application/json', headers=headers)
+
+    def test_post_a_payment_with_expired_idempotency_key(self):
+        """POST with an Idempotency-Key that has expired"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 7, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        headers = {'Idempotency-Key': 'order-7-attempt'}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        IdempotencyKey.query.update({IdempotencyKey.created_at: datetime.utcnow() - timedelta(days=2)})
+        db.session.commit()
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json', headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertFalse('Idempotent-Replayed' in resp.headers)
+        self.assertEqual(Payment.find_by_order(7).count(), 2)
+
+    def test_post_a_batch_of_payments(self):
+        """Create a batch of payments using a POST"""
+        self.add_payment_methods()
+        js = [{'user_id': 0, 'order_id': n, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value} for n in range(5)]
+        js[3]['status'] = 'bad_data'
+        resp = self.app.post('/payments/batch', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = json.loads(resp.data)
+        self.assertEqual(data['ids'], [1, 2, 3, 4])
+        self.assertEqual(len(data['errors']), 1)
+        self.assertEqual(data['errors'][0]['index'], 3)
+        resp = self.app.get('/payments/4')
+        self.assertEqual(json.loads(resp.data)['order_id'], 4)
+
+    def test_post_a_payment_with_unknown_method(self):
+        """Refuse to create or update a payment whose payment method does not exist"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value, 'method_id': 99}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue('payment method 99' in json.loads(resp.data)['message'])
+        js['method_id'] = 1
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        js['method_id'] = 'one'
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(self.app.get('/payments/1').data)['method_id'], 1)
+
+    def test_post_a_batch_of_payments_with_unknown_methods(self):
+        """Reject only the payments of a batch whose payment method does not exist"""
+        self.add_payment_methods()
+        js = [{'user_id': 0, 'order_id': n, 'status': PaymentStatus.UNPAID.value,
+            'method_id': n + 1} for n in range(5)]
+        js[0]['status'] = 'bad_data'
+        resp = self.app.post('/payments/batch', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = json.loads(resp.data)
+        self.assertEqual(data['ids'], [1, 2])
+        self.assertEqual([error['index'] for error in data['errors']], [0, 3, 4])
+
+    def test_post_a_batch_of_payments_as_ndjson(self):
+        """Create a batch of payments from NDJSON using a POST"""
+        self.add_payment_methods()
+        lines = [json.dumps({'user_id': 0, 'order_id': n, 'status': PaymentStatus.PAID.value,
+            'method_id': PaymentMethodType.DEBIT.value}) for n in range(3)]
+        lines.append('{not json')
+        resp = self.app.post('/payments/batch', data='\n'.join(lines), content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = json.loads(resp.data)
+        self.assertEqual(data['ids'], [1, 2, 3])
+        self.assertEqual(data['errors'][0]['index'], 3)
+
+    def test_post_an_invalid_batch_of_payments(self):
+        """POST a batch of payments that are all invalid"""
+        resp = self.app.post('/payments/batch', data=json.dumps([{'user_id': 0}]), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(resp.data)['ids'], [])
+        resp = self.app.post('/payments/batch', data=json.dumps({'user_id': 0}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_a_payment(self):
         """Create a payment, then GET it"""
+        self.add_payment_methods()
         js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
@@ -71,6 +249,291 @@ class TestServer(unittest.TestCase):
         self.assertEqual(p.status, PaymentStatus(js['status']))
         self.assertEqual(p.method_id, js['method_id'])
 
+    def test_get_a_payment_after_update(self):
+        """GET a payment again after it was updated"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.UNPAID.value)
+        js['status'] = PaymentStatus.PROCESSING.value
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.PROCESSING.value)
+        js = {'status': PaymentStatus.PAID.value, 'ids': [1]}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.PAID.value)
+        resp = self.app.delete('/payments/reset')
+        resp = self.app.get('/payments/1')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_a_payment_if_none_match(self):
+        """GET a payment conditionally with its ETag"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        etag = resp.headers['ETag']
+        resp = self.app.get('/payments/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        js['status'] = PaymentStatus.PROCESSING.value
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        resp = self.app.get('/payments/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['version'], 2)
+
+    def test_update_a_payment_if_match(self):
+        """Update a payment only while it matches its ETag"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        etag = resp.headers['ETag']
+        js['status'] = PaymentStatus.PROCESSING.value
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        js['status'] = PaymentStatus.PAID.value
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.PROCESSING.value)
+
+    def test_update_a_payment_at_a_version(self):
+        """Update a payment only while it has the version the body was read at"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        js = json.loads(resp.data)
+        js['status'] = PaymentStatus.PROCESSING.value
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['version'], 2)
+        # A second writer that read version 1 too
+        js['status'] = PaymentStatus.PAID.value
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(json.loads(resp.data)['error'], 'Conflict')
+        js['version'] = 'one'
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.PROCESSING.value)
+
+    def test_patch_a_payment(self):
+        """Change only the fields given of a payment"""
+        self.add_payment_methods()
+        js = {'user_id': 1, 'order_id': 1, 'status': PaymentStatus.UNPAID.value, 'method_id': 1}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        resp = self.app.patch('/payments/1', data=json.dumps({'order_id': 5, 'method_id': 2}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {'id': 1, 'user_id': 1, 'order_id': 5, 'method_id': 2,
+                                                 'status': PaymentStatus.UNPAID.value, 'version': 2})
+        self.assertEqual(resp.headers['ETag'], '"1-2"')
+        resp = self.app.patch('/payments/1', data=json.dumps({'status': PaymentStatus.PROCESSING.value,
+                                                              'user_id': 2, 'version': 2}),
+                              content_type='application/json', headers={'Prefer': 'return=minimal'})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(resp.headers['ETag'], '"1-3"')
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.PROCESSING.value)
+        resp = self.app.get('/payments/summary', query_string='user_id=2')
+        self.assertEqual(json.loads(resp.data)['processing'], 1)
+        resp = self.app.get('/payments/summary', query_string='user_id=1')
+        self.assertEqual(json.loads(resp.data)['total'], 0)
+
+    def test_write_a_payment_whose_method_was_deleted(self):
+        """POST, PUT and PATCH a payment whose method the cached method ids still list"""
+        self.add_payment_methods()
+        js = {'user_id': 1, 'order_id': 1, 'status': PaymentStatus.UNPAID.value, 'method_id': 1}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        # Make SQLite check foreign keys, as MySQL does, on every new connection
+        def check_foreign_keys(connection, record):
+            if db.engine.dialect.name == 'sqlite':
+                connection.execute('PRAGMA foreign_keys=ON')
+        event.listen(db.engine, 'connect', check_foreign_keys)
+        db.session.remove()
+        db.engine.dispose()
+        try:
+            js['method_id'] = 99
+            writes = [lambda: self.app.post('/payments', data=json.dumps(js), content_type='application/json'),
+                      lambda: self.app.put('/payments/1', data=json.dumps(js), content_type='application/json'),
+                      lambda: self.app.patch('/payments/1', data=json.dumps({'method_id': 99}),
+                                             content_type='application/json')]
+            for write in writes:
+                # Another worker deleted method 99 after this one cached its id
+                method_ids.add(99)
+                resp = write()
+                self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('payment method 99 does not exist', json.loads(resp.data)['message'])
+                self.assertEqual(method_ids.missing([99]), set([99]))
+        finally:
+            event.remove(db.engine, 'connect', check_foreign_keys)
+            db.session.remove()
+            db.engine.dispose()
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['method_id'], 1)
+
+    def test_patch_a_payment_with_bad_data(self):
+        """Refuse a sparse update that sets nothing, an unknown field or a bad value"""
+        self.add_payment_methods()
+        js = {'user_id': 1, 'order_id': 1, 'status': PaymentStatus.UNPAID.value, 'method_id': 1}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        for body in [{}, {'version': 1}, {'amount': 5}, {'order_id': 'five'}, {'status': 9}, {'method_id': 99}, []]:
+            resp = self.app.patch('/payments/1', data=json.dumps(body), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch('/payments/2', data=json.dumps({'order_id': 2}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.patch('/payments/2', data=json.dumps({'status': 2}), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['version'], 1)
+
+    def test_patch_a_payment_that_changed(self):
+        """Refuse a sparse update of a payment read at an older version"""
+        self.add_payment_methods()
+        js = {'user_id': 1, 'order_id': 1, 'status': PaymentStatus.UNPAID.value, 'method_id': 1}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        etag = resp.headers['ETag']
+        resp = self.app.patch('/payments/1', data=json.dumps({'order_id': 2}), content_type='application/json',
+                              headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.patch('/payments/1', data=json.dumps({'order_id': 3}), content_type='application/json',
+                              headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.patch('/payments/1', data=json.dumps({'order_id': 3, 'version': 1}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['order_id'], 2)
+
+    def test_get_payment_events(self):
+        """Log the creation, each status change and the deletion of a payment"""
+        self.add_payment_methods()
+        js = {'user_id': 1, 'order_id': 1, 'status': PaymentStatus.UNPAID.value, 'method_id': 1}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        js['status'] = PaymentStatus.PROCESSING.value
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json')
+        js = {'status': PaymentStatus.UNPAID.value, 'filter': {'user_id': 1}}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        resp = self.app.patch('/payments/1', data=json.dumps({'status': PaymentStatus.PROCESSING.value}),
+                              content_type='application/json')
+        js = {'status': PaymentStatus.PAID.value, 'ids': [1]}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        resp = self.app.delete('/payments/1')
+        resp = self.app.get('/payments/1/events')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        moves = [(event['from_status'], event['to_status']) for event in json.loads(resp.data)]
+        self.assertEqual(moves, [(None, 1), (1, 2), (2, 1), (1, 2), (2, 3), (3, None)])
+        resp = self.app.get('/payments/2/events')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_stuck_payments(self):
+        """List the payments that have been in a status for too long"""
+        self.add_payment_methods()
+        js = [{'user_id': 1, 'order_id': n, 'status': PaymentStatus.PROCESSING.value, 'method_id': 1}
+              for n in range(3)]
+        resp = self.app.post('/payments/batch', data=json.dumps(js), content_type='application/json')
+        resp = self.app.get('/payments/stuck')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.app.get('/payments/stuck', query_string='older_than=0')
+        self.assertEqual(sorted(p['id'] for p in json.loads(resp.data)), [1, 2, 3])
+        # Payment 3 moved on, and payment 1 has been processing for an hour
+        js = {'status': PaymentStatus.PAID.value, 'ids': [3]}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        PaymentEvent.query.filter_by(payment_id=1).update({'created_at': datetime.utcnow() - timedelta(hours=1)})
+        db.session.commit()
+        resp = self.app.get('/payments/stuck')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([(p['id'], p['status']) for p in data], [(1, PaymentStatus.PROCESSING.value)])
+        resp = self.app.get('/payments/stuck', query_string='older_than=0&limit=5')
+        self.assertEqual([p['id'] for p in json.loads(resp.data)], [1, 2])
+        resp = self.app.get('/payments/stuck', query_string='status=PAID&older_than=0')
+        self.assertEqual([p['id'] for p in json.loads(resp.data)], [3])
+        for query_string in ['status=REFUNDED', 'older_than=-1', 'limit=0']:
+            resp = self.app.get('/payments/stuck', query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_payments_if_none_match(self):
+        """GET a listing conditionally with its ETag"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        resp = self.app.get('/payments', query_string='limit=10')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/payments', query_string='limit=10', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # An unpaginated listing only computes its weak ETag for a conditional request
+        resp = self.app.get('/payments')
+        self.assertNotIn('ETag', resp.headers)
+        resp = self.app.get('/payments', headers={'If-None-Match': '"none"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.headers['ETag'].startswith('W/'))
+        resp = self.app.get('/payments', headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        js = {'status': PaymentStatus.PROCESSING.value, 'ids': [1]}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        resp = self.app.get('/payments', query_string='limit=10', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_get_a_payment_with_its_method(self):
+        """GET a payment with its payment method embedded"""
+        method = PaymentMethod(method_type=PaymentMethodType.PAYPAL, is_default=False)
+        method.save()
+        payment = Payment(user_id=1, order_id=2, status=PaymentStatus.UNPAID, method_id=method.id)
+        payment.save()
+        resp = self.app.get('/payments/%d' % payment.id, query_string='expand=method')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['method'], method.serialize())
+        self.assertEqual(data['method_id'], method.id)
+        etag = resp.headers['ETag']
+        self.app.put('/payments/methods/%d/set-default' % method.id)
+        resp = self.app.get('/payments/%d' % payment.id, query_string='expand=method',
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(json.loads(resp.data)['method']['is_default'])
+        resp = self.app.get('/payments/%d' % (payment.id + 1), query_string='expand=method')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_payments_with_their_methods(self):
+        """GET a listing, streamed and paged, with each payment method embedded"""
+        credit = PaymentMethod(method_type=PaymentMethodType.CREDIT, is_default=False)
+        credit.save()
+        debit = PaymentMethod(method_type=PaymentMethodType.DEBIT, is_default=True)
+        debit.save()
+        for n, method in enumerate([credit, debit, credit]):
+            Payment(user_id=1, order_id=n, status=PaymentStatus.UNPAID, method_id=method.id).save()
+        for query_string in ['expand=method', 'expand=method&limit=2']:
+            resp = self.app.get('/payments', query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = json.loads(resp.data)
+            self.assertEqual(data[0]['method'], credit.serialize())
+            self.assertEqual(data[1]['method'], debit.serialize())
+        self.assertTrue('expand=method' in resp.headers['Link'])
+        resp = self.app.get('/payments', query_string='limit=2')
+        self.assertFalse('method' in json.loads(resp.data)[0])
+
+    def test_get_payments_with_bad_expand(self):
+        """GET a listing that asks to embed something unknown"""
+        resp = self.app.get('/payments', query_string='expand=user')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_a_payment_404(self):
         """Try to GET a payment that doesn't exist"""
         resp = self.app.get('/payments/1')
@@ -78,6 +541,7 @@ class TestServer(unittest.TestCase):
 
     def test_get_all_payments(self):
         """GET all payments in the database"""
+        self.add_payment_methods()
         js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
@@ -91,21 +555,111 @@ class TestServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self.assertEqual(len(json.loads(resp.data)), 2)
 
+    def test_get_all_payments_without_ujson(self):
+        """GET all payments with the standard json encoder"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        with patch.object(server, 'fast_json', None):
+            # The listing is streamed, so it is only encoded as its body is read
+            resp = self.app.get('/payments')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(json.loads(resp.data)[0]['status'], PaymentStatus.UNPAID.value)
+
+    def test_get_payments_by_page(self):
+        """GET payments one page at a time"""
+        self.add_payment_methods()
+        for user_id in range(3):
+            js = {'user_id': user_id, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+                'method_id': PaymentMethodType.CREDIT.value}
+            resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        resp = self.app.get('/payments', query_string='limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['id'] for p in data], [1, 2])
+        self.assertEqual(resp.headers['X-Next-Cursor'], '2')
+        self.assertTrue('after=2' in resp.headers['Link'])
+
+        resp = self.app.get('/payments', query_string='limit=2&after=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['id'] for p in data], [3])
+        self.assertFalse('Link' in resp.headers)
+
+    def test_export_payments(self):
+        """Export the payments matching a filter as NDJSON and as CSV"""
+        self.add_payment_methods()
+        for order_id in range(3):
+            Payment(user_id=order_id % 2, order_id=order_id, status=PaymentStatus.PAID, method_id=1).save()
+        resp = self.app.get('/payments/export', query_string='user_id=0')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual([line['order_id'] for line in lines], [0, 2])
+        resp = self.app.get('/payments/export', query_string='format=csv')
+        self.assertEqual(resp.mimetype, 'text/csv')
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0], 'id,user_id,order_id,status,method_id,version')
+        self.assertEqual(lines[2], '2,1,1,%d,1,1' % PaymentStatus.PAID.value)
+        self.assertEqual(len(lines), 4)
+
+    def test_export_payments_gzipped(self):
+        """Export payments compressed on the fly for a client that accepts gzip"""
+        self.add_payment_methods()
+        for order_id in range(5):
+            Payment(user_id=0, order_id=order_id, status=PaymentStatus.UNPAID, method_id=1).save()
+        plain = self.app.get('/payments/export').data
+        resp = self.app.get('/payments/export', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(resp.data, zlib.MAX_WBITS | 16), plain)
+        resp = self.app.get('/payments/export', query_string='format=xml')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_payments_with_bad_limit(self):
+        """GET payments with a limit that is out of range"""
+        resp = self.app.get('/payments', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/payments', query_string='limit=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_payment(self):
         """Update an existing Payment"""
+        self.add_payment_methods()
         js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
-        js = {'user_id': 0, "order_id": 0, 'status': PaymentStatus.PAID.value,
+        js = {'user_id': 0, "order_id": 0, 'status': PaymentStatus.PROCESSING.value,
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.put('payments/1', data=json.dumps(js), content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         new_json = json.loads(resp.data)
-        self.assertEqual(new_json['status'], PaymentStatus.PAID.value)
+        self.assertEqual(new_json['status'], PaymentStatus.PROCESSING.value)
+
+    def test_update_payment_to_an_illegal_status(self):
+        """Refuse to move a Payment to a status it may not reach from its own"""
+        self.add_payment_methods()
+        js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+            'method_id': PaymentMethodType.CREDIT.value}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        js['status'] = PaymentStatus.PAID.value
+        resp = self.app.put('payments/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn('cannot move from UNPAID to PAID', json.loads(resp.data)['message'])
+        resp = self.app.patch('payments/1', data=json.dumps({'status': PaymentStatus.PAID.value}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.UNPAID.value)
+        self.assertEqual(json.loads(resp.data)['version'], 1)
 
     def test_update_payment_with_no_data(self):
         """ Update a Payment with no data passed """
+        self.add_payment_methods()
         js = {'user_id': 0, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
@@ -115,6 +669,7 @@ class TestServer(unittest.TestCase):
 
     def test_update_payment_not_found(self):
         """Update a Payment that does not exist"""
+        self.add_payment_methods()
         new_payment = {'user_id': 0, 'order_id': 0, 'status': 3, 'method_id': 1}
         data = json.dumps(new_payment)
         resp = self.app.put('/payments/4', data=data, content_type='application/json')
@@ -122,6 +677,7 @@ class TestServer(unittest.TestCase):
 
     def test_query_payment_by_user(self):
         """ Query Payment by user ID """
+        self.add_payment_methods()
         js = {'user_id': 1, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments', data=json.dumps(js), follow_redirects=True, content_type='application/json')
@@ -139,6 +695,7 @@ class TestServer(unittest.TestCase):
 
     def test_query_payment_by_order(self):
         """ Query Payment by order ID """
+        self.add_payment_methods()
         js = {'user_id': 0, 'order_id': 1, 'status': PaymentStatus.UNPAID.value,
             'method_id': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments', data=json.dumps(js), follow_redirects=True, content_type='application/json')
@@ -154,6 +711,146 @@ class TestServer(unittest.TestCase):
         query_item = data[0]
         self.assertEqual(query_item['order_id'], 2)
 
+    def test_query_payment_by_status_and_method(self):
+        """ Query Payments by status and method ID together """
+        self.add_payment_methods()
+        for order_id, payment_status, method_id in [(1, PaymentStatus.UNPAID, 1),
+                                                    (2, PaymentStatus.PAID, 1),
+                                                    (3, PaymentStatus.PAID, 2)]:
+            js = {'user_id': 0, 'order_id': order_id, 'status': payment_status.value,
+                'method_id': method_id}
+            resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get('/payments', query_string='status=3&method_id=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['order_id'] for p in data], [2])
+        resp = self.app.get('/payments', query_string='user_id=0&status=paid')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_query_payment_by_bad_status(self):
+        """ Query Payments by a status that does not exist """
+        resp = self.app.get('/payments', query_string='status=refunded')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_status_of_payments_by_id(self):
+        """ Move a list of Payments to a new status """
+        self.add_payment_methods()
+        for payment_status in [PaymentStatus.PROCESSING, PaymentStatus.PROCESSING, PaymentStatus.UNPAID]:
+            js = {'user_id': 0, 'order_id': 0, 'status': payment_status.value,
+                'method_id': PaymentMethodType.CREDIT.value}
+            resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        js = {'status': 'PAID', 'ids': [1, 2, 3, 9]}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['updated'], 2)
+        self.assertEqual(data['ids'], [1, 2])
+        self.assertEqual([s['id'] for s in data['skipped']], [3, 9])
+        resp = self.app.get('/payments/2')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.PAID.value)
+        resp = self.app.get('/payments/3')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.UNPAID.value)
+
+    def test_update_status_of_payments_by_filter(self):
+        """ Move the Payments matching a filter to a new status """
+        self.add_payment_methods()
+        for user_id in [1, 1, 2]:
+            js = {'user_id': user_id, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+                'method_id': PaymentMethodType.CREDIT.value}
+            resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        js = {'status': PaymentStatus.PROCESSING.value, 'filter': {'user_id': 1}}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['updated'], 2)
+        resp = self.app.get('/payments', query_string='status=PROCESSING')
+        self.assertEqual([p['user_id'] for p in json.loads(resp.data)], [1, 1])
+
+    def test_update_status_of_payments_with_bad_data(self):
+        """ Move Payments to a status that does not exist """
+        self.add_payment_methods()
+        js = {'status': 'refunded', 'ids': [1]}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        js = {'status': 'PAID', 'filter': {'amount': 1}}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for filters in [{}, {'user_id': '1'}, {'order_id': None}, {'method_id': True}, {'status': 'lost'}]:
+            js = {'status': 'PAID', 'filter': filters}
+            resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # JSON booleans are not ids or statuses, though Python counts True as 1
+        js = {'user_id': 1, 'order_id': 0, 'status': PaymentStatus.UNPAID.value, 'method_id': 1}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        for js in [{'status': PaymentStatus.PROCESSING.value, 'ids': [True]}, {'status': True, 'ids': [1]},
+                   {'status': PaymentStatus.PROCESSING.value, 'filter': {'status': True}}]:
+            resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.UNPAID.value)
+
+    def test_update_status_of_payments_with_an_empty_filter(self):
+        """ Refuse to move every payment with an empty filter """
+        self.add_payment_methods()
+        js = {'user_id': 1, 'order_id': 0, 'status': PaymentStatus.UNPAID.value, 'method_id': 1}
+        resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+        js = {'status': PaymentStatus.PROCESSING.value, 'filter': {}}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('at least one field', json.loads(resp.data)['message'])
+        resp = self.app.get('/payments/1')
+        self.assertEqual(json.loads(resp.data)['status'], PaymentStatus.UNPAID.value)
+
+    def test_get_payment_summary(self):
+        """ Keep the summaries of a user and of everyone up to date through every write """
+        self.add_payment_methods()
+        for user_id in [1, 1, 2]:
+            js = {'user_id': user_id, 'order_id': 0, 'status': PaymentStatus.UNPAID.value,
+                'method_id': PaymentMethodType.CREDIT.value}
+            resp = self.app.post('/payments', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        js = [{'user_id': 1, 'order_id': 1, 'status': PaymentStatus.PROCESSING.value, 'method_id': 1}]
+        resp = self.app.post('/payments/batch', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get('/payments/summary', query_string='user_id=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {'user_id': 1, 'unpaid': 2, 'processing': 1, 'paid': 0,
+                                                 'outstanding': 3, 'total': 3})
+        # Moved to another user and status by a PUT, then by id and by filter
+        js = {'user_id': 2, 'order_id': 0, 'status': PaymentStatus.PROCESSING.value, 'method_id': 1}
+        resp = self.app.put('/payments/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        js = {'status': PaymentStatus.PAID.value, 'ids': [1, 4]}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(json.loads(resp.data)['updated'], 2)
+        js = {'status': PaymentStatus.PROCESSING.value, 'filter': {'user_id': 2}}
+        resp = self.app.patch('/payments/status', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(json.loads(resp.data)['updated'], 1)
+        resp = self.app.get('/payments/summary', query_string='user_id=1')
+        self.assertEqual(json.loads(resp.data)['paid'], 1)
+        self.assertEqual(json.loads(resp.data)['unpaid'], 1)
+        resp = self.app.get('/payments/summary', query_string='user_id=2')
+        self.assertEqual(json.loads(resp.data)['paid'], 1)
+        self.assertEqual(json.loads(resp.data)['processing'], 1)
+        resp = self.app.delete('/payments/3')
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get('/payments/summary')
+        self.assertEqual(json.loads(resp.data), {'unpaid': 1, 'processing': 0, 'paid': 2,
+                                                 'outstanding': 1, 'total': 3})
+        resp = self.app.delete('/payments/reset')
+        resp = self.app.get('/payments/summary', query_string='user_id=1')
+        self.assertEqual(json.loads(resp.data)['total'], 0)
+        resp = self.app.get('/payments/summary')
+        self.assertEqual(json.loads(resp.data)['total'], 0)
+
+    def test_get_payment_summary_with_bad_user(self):
+        """ Summarize the payments of a user_id that is not an integer """
+        resp = self.app.get('/payments/summary', query_string='user_id=abc')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     # def test_delete_payment(self):
     #     """ Delete a payment """
     #     # First insert a payment
@@ -239,10 +936,14 @@ class TestServer(unittest.TestCase):
         js = {'method_type': PaymentMethodType.CREDIT.value}
         resp = self.app.post('/payments/methods', data=json.dumps(js), content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get('/payments/methods/1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
         # Now delete the payment method
         resp = self.app.delete('/payments/methods/1', content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
         self.assertEqual(len(resp.data), 0)
+        resp = self.app.get('/payments/methods/1')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
         # Assert that no payment methods are present
         resp = self.app.get('/payments/methods')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
@@ -270,6 +971,72 @@ class TestServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(new_json['method_type'], PaymentMethodType.DEBIT.value)
 
+    def test_update_a_payment_method_if_match(self):
+        """Update a payment method only while it matches its ETag and version"""
+        js = {'method_type': PaymentMethodType.CREDIT.value}
+        resp = self.app.post('/payments/methods', data=json.dumps(js), content_type='application/json')
+        resp = self.app.get('/payments/methods/1')
+        etag = resp.headers['ETag']
+        self.assertEqual(json.loads(resp.data)['version'], 1)
+        resp = self.app.get('/payments/methods/1', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        js = {'method_type': PaymentMethodType.DEBIT.value, 'version': 1}
+        resp = self.app.put('/payments/methods/1', data=json.dumps(js), content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        js = {'method_type': PaymentMethodType.PAYPAL.value}
+        resp = self.app.put('/payments/methods/1', data=json.dumps(js), content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        js['version'] = 1
+        resp = self.app.put('/payments/methods/1', data=json.dumps(js), content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.get('/payments/methods/1', headers={'If-None-Match': etag})
+        self.assertEqual(json.loads(resp.data)['method_type'], PaymentMethodType.DEBIT.value)
+
+    def test_patch_a_payment_method(self):
+        """Change only the fields given of a payment method"""
+        js = {'method_type': PaymentMethodType.CREDIT.value, 'is_default': True}
+        resp = self.app.post('/payments/methods', data=json.dumps(js), content_type='application/json')
+        resp = self.app.get('/payments/methods/1')
+        resp = self.app.patch('/payments/methods/1', data=json.dumps({'method_type': PaymentMethodType.PAYPAL.value}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), {'id': 1, 'method_type': PaymentMethodType.PAYPAL.value,
+                                                 'is_default': True, 'version': 2})
+        resp = self.app.get('/payments/methods/1')
+        self.assertEqual(json.loads(resp.data)['method_type'], PaymentMethodType.PAYPAL.value)
+        resp = self.app.patch('/payments/methods/1', data=json.dumps({'is_default': 'no'}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch('/payments/methods/1', data=json.dumps({'is_default': False, 'version': 1}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.patch('/payments/methods/7', data=json.dumps({'is_default': False}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_patch_a_payment_method_to_be_the_default(self):
+        """Keep a single default payment method when one is patched to be it"""
+        self.add_payment_methods()
+        resp = self.app.put('/payments/methods/1/set-default')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/payments/methods/1')
+        self.assertTrue(json.loads(resp.data)['is_default'])
+        resp = self.app.patch('/payments/methods/2', data=json.dumps({'is_default': True}),
+                              content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(json.loads(resp.data)['is_default'])
+        resp = self.app.get('/payments/methods')
+        defaults = [(m['id'], m['version']) for m in json.loads(resp.data) if m['is_default']]
+        self.assertEqual(defaults, [(2, 2)])
+        resp = self.app.get('/payments/methods/1')
+        self.assertEqual(json.loads(resp.data)['is_default'], False)
+        self.assertEqual(json.loads(resp.data)['version'], 3)
+        resp = self.app.get('/payments/methods/3')
+        self.assertEqual(json.loads(resp.data)['version'], 1)
+
     def test_update_payment_method_with_no_data(self):
         """ Update a Payment Method with no data passed """
         js = {'method_type': PaymentMethodType.CREDIT.value}
@@ -284,6 +1051,23 @@ class TestServer(unittest.TestCase):
         resp = self.app.put('/payments/methods/4', data=json.dumps(js), content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_set_default_payment_method(self):
+        """Set a payment method as the default, then GET the default"""
+        resp = self.app.get('/payments/methods/default')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        for method_type in [PaymentMethodType.CREDIT, PaymentMethodType.DEBIT]:
+            js = {'method_type': method_type.value, 'is_default': True}
+            resp = self.app.post('/payments/methods', data=json.dumps(js), content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.put('/payments/methods/1/set-default', content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['is_default'], True)
+        resp = self.app.get('/payments/methods/2')
+        self.assertEqual(json.loads(resp.data)['is_default'], False)
+        resp = self.app.get('/payments/methods/default')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data)['id'], 1)
+
     def test_payment_reset(self):
         """test"""
         # Create a new payment mehtod and assert it is not the default
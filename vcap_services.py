@@ -6,6 +6,9 @@ def get_database_uri():
     """
     Initialized MySQL database connection
     """
+    # A complete URI, e.g. sqlite:////tmp/payments.db for local runs and benchmarks
+    if 'DATABASE_URI' in os.environ:
+        return os.environ['DATABASE_URI']
     # Get credentials from the Bluemix environment
     if 'VCAP_SERVICES' in os.environ:
         logging.info("Using VCAP_SERVICES...")
@@ -39,3 +42,19 @@ def get_database_uri():
     else:
         connect_string = 'mysql+pymysql://{}:{}@{}:{}/{}'
         return connect_string.format(username, password, hostname, port, name)
+
+
+def get_pool_options():
+    """
+    Connection pool settings for the MySQL engine, from the environment
+
+    ClearDB closes idle connections, so they are recycled before that happens
+    and pinged on checkout, rather than failing with "MySQL server has gone away".
+    """
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '280')),
+        'pool_pre_ping': (os.getenv('DB_POOL_PRE_PING', 'True') == 'True'),
+    }